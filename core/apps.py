@@ -1,6 +1,13 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class CoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'core'
+
+    def ready(self):
+        # 配置了 PRELOAD_AI_SERVICE 时在启动阶段创建共享的 DeepSeekService；没配置 API Key 时（如只跑 migrate）跳过
+        if settings.PRELOAD_AI_SERVICE and settings.DEEPSEEK_API_KEY:
+            from .services.deepseek_service import get_service
+            get_service()
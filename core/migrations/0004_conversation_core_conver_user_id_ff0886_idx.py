@@ -0,0 +1,17 @@
+# Generated by Django 4.2.19 on 2026-10-15 22:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_conversation_knowledge_points_alter_interaction_type_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['user', 'status'], name='core_conver_user_id_ff0886_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.19 on 2026-10-15 22:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_conversation_core_conver_user_id_ff0886_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['user', '-updated_at'], name='core_conver_user_id_3e2a4b_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='interaction',
+            index=models.Index(fields=['conversation', 'id'], name='core_intera_convers_66e357_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='interaction',
+            index=models.Index(fields=['conversation', '-created_at'], name='core_intera_convers_34c1a1_idx'),
+        ),
+    ]
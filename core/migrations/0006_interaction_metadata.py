@@ -0,0 +1,43 @@
+# Generated by Django 4.2.19 on 2026-10-15 22:20
+
+import json
+import re
+
+from django.db import migrations, models
+
+_CHALLENGE_RE = re.compile(r'\s*<CHALLENGE>(.*?)</CHALLENGE>', re.S)
+
+
+def move_challenges_to_metadata(apps, schema_editor):
+    """
+    旧数据把挑战题以 <CHALLENGE>JSON</CHALLENGE> 拼在 text_content 末尾，迁移到 metadata 里
+    """
+    Interaction = apps.get_model('core', 'Interaction')
+    rows = Interaction.objects.filter(text_content__contains='<CHALLENGE>').only('id', 'text_content')
+    for interaction in rows.iterator():
+        match = _CHALLENGE_RE.search(interaction.text_content)
+        if not match:
+            continue
+        try:
+            challenge = json.loads(match.group(1))
+        except ValueError:
+            continue
+        interaction.text_content = _CHALLENGE_RE.sub('', interaction.text_content, count=1)
+        interaction.metadata = {'challenge': challenge}
+        interaction.save(update_fields=['text_content', 'metadata'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_conversation_core_conver_user_id_3e2a4b_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='interaction',
+            name='metadata',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.RunPython(move_challenges_to_metadata, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.19 on 2026-10-15 22:22
+
+from django.db import migrations, models
+
+
+def backfill_demo_step(apps, schema_editor):
+    """
+    进行中的演示对话：步数 = 已有的 AI 回复条数
+    """
+    Conversation = apps.get_model('core', 'Conversation')
+    demos = Conversation.objects.filter(topic__startswith='[DEMO]').annotate(
+        ai_count=models.Count('interactions', filter=models.Q(interactions__type__in=['ai_feedback', 'ai_image']))
+    )
+    for conversation in demos.iterator():
+        Conversation.objects.filter(pk=conversation.pk).update(demo_step=conversation.ai_count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_interaction_metadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='demo_step',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_demo_step, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.19 on 2026-10-15 22:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_conversation_demo_step'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='interaction',
+            name='conversation',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='interactions', to='core.conversation'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.19 on 2026-10-15 22:43
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_interaction_conversation_no_fk_index'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='interaction',
+            name='core_intera_convers_34c1a1_idx',
+        ),
+    ]
@@ -18,12 +18,11 @@ class UserProfile(models.Model):
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
-    if created:
-        UserProfile.objects.create(user=instance)
-
-@receiver(post_save, sender=User)
-def save_user_profile(sender, instance, **kwargs):
-    instance.profile.save()
+    """
+    保证每个用户都有 profile（包括早于该信号创建的老用户：登录时会保存 last_login，顺带补上）
+    """
+    if created or not hasattr(instance, 'profile'):
+        UserProfile.objects.get_or_create(user=instance)
 
 class Classroom(models.Model):
     name = models.CharField(max_length=100)
@@ -69,6 +68,17 @@ class Conversation(models.Model):
     # 存储上下文摘要，用于 prompt
     context_summary = models.TextField(blank=True, null=True)
 
+    # 演示脚本进行到第几步（= 对话中 AI 回复的条数），避免每条消息都 COUNT 一次
+    demo_step = models.PositiveSmallIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # chat_view 按 (user, status) 查找未开始的空对话
+            models.Index(fields=['user', 'status']),
+            # 侧边栏 / 班级统计按用户列出最近的对话
+            models.Index(fields=['user', '-updated_at']),
+        ]
+
     def __str__(self):
         return f"{self.user.username} - {self.topic[:20]}"
 
@@ -83,19 +93,27 @@ class Interaction(models.Model):
         ('user_synthesis', '用户总结'), # Added missing type
     ]
 
-    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='interactions')
+    # 外键上不再单独建索引：下面的 (conversation, id) 组合索引以 conversation 开头，已能覆盖按对话过滤，每次 INSERT 少维护一棵索引
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='interactions', db_index=False)
     type = models.CharField(max_length=20, choices=INTERACTION_TYPES)
     
     # 内容字段
     text_content = models.TextField(blank=True, null=True) # 通用文本字段
     image_url = models.URLField(blank=True, null=True) # AI生成的图片URL
     image_prompt = models.TextField(blank=True, null=True) # 生成图片的Prompt
+    metadata = models.JSONField(blank=True, null=True) # 结构化附加数据，例如 {'challenge': {...}}
     
     # 状态标记
     is_passed = models.BooleanField(default=False, help_text="用户的解读是否通过验证")
     
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # 对话内的交互一律按 id 排序：整段对话、最近几条上下文 (order_by('-id')[:5]) 和回滚 (id__gt)
+            models.Index(fields=['conversation', 'id']),
+        ]
+
     def __str__(self):
         return f"{self.conversation.id} - {self.type}"
 
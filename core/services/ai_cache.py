@@ -0,0 +1,15 @@
+import hashlib
+
+# 已转存到本地的图片在缓存中保留 24 小时，相同 prompt 直接复用，不再请求生图服务
+IMAGE_CACHE_TTL = 60 * 60 * 24
+
+
+def image_cache_key(prompt):
+    return f"img:{hashlib.sha256(prompt.encode('utf-8')).hexdigest()}"
+
+
+
+# 生图失败时返回的占位图：不转存到本地，也不写进上面的缓存
+IMAGE_KEY_MISSING_URL = "https://placehold.co/1024x1024/png?text=API+Key+Missing"
+IMAGE_ERROR_URL = "https://placehold.co/1024x1024/png?text=Image+Error"
+PLACEHOLDER_IMAGE_URLS = frozenset({IMAGE_KEY_MISSING_URL, IMAGE_ERROR_URL})
@@ -1,191 +1,352 @@
-import json
+import base64
+import functools
+import logging
+import random
+import threading
 import urllib.parse
+from concurrent.futures import Future
 from django.conf import settings
+from django.core.cache import cache
 from openai import OpenAI
-from core.utils import save_image_from_url
+from core.utils import HTTP_TIMEOUT, create_http_session, create_openai_http_client
+from core.services.json_stream import parse_json
+from core.services.llm_cache import llm_cache
+from core.services.ai_cache import IMAGE_ERROR_URL, IMAGE_KEY_MISSING_URL, image_cache_key
+
+logger = logging.getLogger(__name__)
+
+_JSON_RESPONSE_FORMAT = {"type": "json_object"}
+
+SILICONFLOW_IMAGE_URL = "https://api.siliconflow.cn/v1/images/generations"
+SILICONFLOW_CHAT_URL = "https://api.siliconflow.cn/v1/chat/completions"
+
+# 识图模型 (Qwen2-VL)，72B 失败时退回 7B
+VISION_MODEL = "Qwen/Qwen2-VL-72B-Instruct"
+VISION_FALLBACK_MODEL = "Qwen/Qwen2-VL-7B-Instruct"
+
+# 进程内正在生成的图片：相同 prompt 的并发请求等待同一次调用的结果
+_inflight_images = {}
+_inflight_lock = threading.Lock()
+
+_SYSTEM_PROMPT_ANALYZE = """
+You are a **Teacher's Assistant for Guided Problem Solving**. 
+Your goal is to help a student solve a problem by guiding them through a **sequential visual narrative**.
+
+**CORE RULES:**
+1. **NEVER** provide the direct final answer. If the student asks for it, refuse gently and ask a guiding question.
+2. **VISUAL FIRST**: Instead of long text explanations, generate images or Desmos graphs that depict the **process** or **concept**.
+3. **STEP-BY-STEP**: Break the problem down into small, manageable cognitive steps.
+
+Analyze the user's input and context to determine the Next Visual Scene.
+
+**CRITICAL STEP: Determine User Intent & Cognitive State**
+1. **User is Clueless** ("I don't know", "No idea", "Tell me"):
+   - Action: **PROBE_DEEPER**. Do NOT generate a visual yet. Ask a simpler, foundational question to spark their intuition.
+   - Return intent="probe_deeper".
+2. **User has a Guess/Hypothesis** (Even if wrong):
+   - Action: **VISUALIZE**. Generate a visual (Image or Desmos) to test or illustrate their guess.
+   - Return intent="has_idea".
+3. **User is Explaining/Analyzing**:
+   - Action: **EVALUATE**. Check if their understanding is correct.
+   - If they are close to the answer, VERIFY understanding with a **Fill-in-the-Blank Challenge**.
+   - Return intent="verify_understanding".
+   - Return intent="explaining_image" if more visual steps are needed.
+   - Return intent="finish" ONLY if the entire logical chain is complete and user fully understands the final answer.
+   
+**CRITICAL STEP: Determine Cognitive Level & Visual Tool (Only if visualizing)**
+1. **Curiosity/Nature/Life** (e.g., "Why is sky blue?", "History"):
+   - Tool: **IMAGE_GENERATION** (Flux.1)
+   - Style: **REALISTIC, CINEMATIC, DOCUMENTARY**.
+2. **Math/Functions/Geometry** (e.g., "y=x^2", "Parabola", "Monotonicity"):
+   - Tool: **DESMOS_CALCULATOR**
+   - Action: Generate a specific LaTeX formula.
+   - **IMPORTANT**: For concepts like "Monotonicity" or "Quadratic", do NOT just give a static formula like "y=x^2".
+   - **USE SLIDERS**: Create EXPLORATORY formulas using parameters (a, b, c).
+   - Example: Instead of "y=x^2", output "y=ax^2+bx+c". Desmos will automatically create sliders for a, b, c.
+   - Example: "y = sin(ax) + b".
+   - Goal: Allow user to manipulate the graph to discover the property.
+3. **Academic/Abstract/Logic**:
+   - Tool: **IMAGE_GENERATION**
+   - Style: **MINIMALIST, INFOGRAPHIC**.
+
+RETURN JSON FORMAT:
+{
+    "intent": "has_idea" | "no_idea" | "explaining_image" | "probe_deeper" | "verify_understanding" | "finish",
+    "tool": "image_generation" | "desmos" | "fill_in_the_blank",
+    "desmos_latex": "y=ax^2+c" (Generate dynamic formulas with parameters a,b,c where possible),
+    "fill_in_the_blank": {
+        "question": "The sentence with ___ blank.",
+        "correct_answer": "answer",
+        "hint": "hint"
+    },
+    "evaluation": "pass" | "fail",
+    "feedback": "Short feedback in Chinese.",
+    "next_step_hint": "Hint if failed.",
+    "visual_prompt": "English prompt for Flux.1",
+    "visual_guide_text": "Chinese guide text."
+}
+"""
+_SYSTEM_MSG_ANALYZE = {"role": "system", "content": _SYSTEM_PROMPT_ANALYZE}
+
+_SYSTEM_PROMPT_VISUAL_PROMPT = """
+You are a Visual Thinking Expert. Convert the abstract logic into a concrete, metaphorical visual scene.
+
+**Determine the Subject Matter & Style:**
+- **Nature/Real Life:** Use "Cinematic, Photorealistic, National Geographic Style".
+- **Academic/Abstract/Logic/Math:** Use "Minimalist, Schematic, Blueprint, Infographic, Vector Art, Clean Lines, High Concept".
+
+OUTPUT ONLY THE VISUAL DESCRIPTION PROMPT IN ENGLISH. NO OTHER TEXT.
+Style should be consistent with the subject matter.
+"""
+_SYSTEM_MSG_VISUAL_PROMPT = {"role": "system", "content": _SYSTEM_PROMPT_VISUAL_PROMPT}
+
+_SYSTEM_PROMPT_INITIAL_PROBE = """
+你是一个苏格拉底式的思维导师。用户刚提出了一个问题。
+你的任务是：
+1. 确认收到问题。
+2. 询问用户目前对这个问题是否有初步的直觉或想法。
+
+要求：
+- 语气温暖、专业、具有同理心。
+- 必须包含“初步想法”或“直觉”这个核心询问点。
+- 不要直接回答问题，而是引导用户开始思考。
+- 100字以内。
+"""
+_SYSTEM_MSG_INITIAL_PROBE = {"role": "system", "content": _SYSTEM_PROMPT_INITIAL_PROBE}
+
+# 预置的初始引导语：按问题的大致类别挑一句，不再为固定意图的开场白调用 LLM
+_PROBE_KEYWORDS = [
+    ('math', ('方程', '函数', '几何', '三角', '概率', '数列', '证明', '求解', '计算', '面积', '角度', '导数', '积分', '数学')),
+    ('science', ('物理', '化学', '生物', '速度', '能量', '电', '光', '引力', '相对论', '分子', '细胞', '实验')),
+    ('language', ('作文', '阅读', '文章', '诗', '翻译', '英语', '语文', '语法', '单词', '写作')),
+]
+_INITIAL_PROBES = {
+    'math': [
+        "收到，这是一道很值得琢磨的数学题。先别急着算——你的直觉是什么？你觉得突破口可能在哪里？",
+        "好问题。在动笔之前，说说你的初步想法：题目里哪个条件让你觉得最关键？",
+        "我看到你的题目了。你现在有什么直觉吗？哪怕只是一个模糊的方向也可以说说。",
+    ],
+    'science': [
+        "收到。这个现象背后一定有它的道理——你的直觉是什么？你觉得是什么在起作用？",
+        "好问题。先凭直觉猜一猜：如果让你解释这件事，你的初步想法是什么？",
+        "我明白你想弄懂的是什么了。在查资料之前，你自己有什么初步想法或直觉吗？",
+    ],
+    'language': [
+        "收到。读完这个问题，你的第一直觉是什么？先说说你的初步想法吧。",
+        "好的。你觉得这里最让你拿不准的是哪一点？先把你的初步想法告诉我。",
+        "我看到了。在分析之前，你对它有什么直觉或初步想法吗？",
+    ],
+    'general': [
+        "收到。关于这个问题，你现在有什么初步的想法或直觉吗？",
+        "好问题。先不急着找答案——你的直觉告诉你什么？说说你的初步想法吧。",
+        "我明白了。在我们一起拆解之前，你对这个问题有什么初步想法或直觉吗？",
+        "收到你的问题了。哪怕还不确定，也先说说你的直觉：你觉得答案可能和什么有关？",
+    ],
+}
+
+_IMAGE_ANALYSIS_PROMPT = """
+你是一个苏格拉底式的思维导师。用户上传了一张图片，这很可能是一道题目（选择题、填空题等），或者他的手写草稿。
+
+**你的核心宗旨：培养用户的独立思考能力。**
+
+你的任务：
+1. **识别题目/内容**：简单确认你看到了什么题目或内容（证明你看懂了）。
+2. **绝不直接给答案**：无论题目多简单，都严禁直接给出选项或结果。
+3. **启发式引导**：
+   - 如果是题目，请分析解题的关键突破口，反问用户是否注意到了某个条件。
+   - 如果是草稿，指出其思路中的亮点或盲点。
+
+请用**简短、口语化**的语气（100字以内）回复：
+"我看到了这道关于...的题。你觉得解这道题的关键是什么？是...吗？" 类似的引导风格。
+"""
+
+# 用户附带了文字说明时的图片分析 Prompt，模板在模块加载时定好，调用时只填入附言
+_IMAGE_ANALYSIS_WITH_TEXT_PROMPT = """
+用户上传了一张图片（可能是题目），并附言："{prompt}"。
+
+**你的核心宗旨：培养用户的独立思考能力。**
+
+你的任务：
+1. 结合图片和附言，理解用户的困惑点。
+2. **绝不直接给答案**。
+3. **引导思考**：针对用户的疑问，给出一个思维脚手架（Scaffolding），引导他自己迈出下一步。
+
+请用**简短、口语化**的语气（100字以内）回复。
+"""
 
 class DeepSeekService:
     def __init__(self):
         self.api_key = getattr(settings, 'DEEPSEEK_API_KEY', '')
         self.client = OpenAI(
             api_key=self.api_key,
-            base_url="https://api.deepseek.com"
+            base_url="https://api.deepseek.com",
+            http_client=create_openai_http_client()
         )
+        self.llm_model = "deepseek-chat"
+        # SiliconFlow 生图/识图接口共用的连接池
+        self.session = create_http_session()
 
-    def chat_completion(self, messages, json_mode=False):
+    def chat_completion(self, messages):
         """
         调用 DeepSeek V3
         """
+        return self._chat_completion(messages, None)
+
+    def chat_completion_json(self, messages):
+        """
+        JSON 模式 (response_format=json_object) 的 chat_completion
+        """
+        return self._chat_completion(messages, _JSON_RESPONSE_FORMAT)
+
+    def _chat_completion(self, messages, response_format):
+        return self._chat_completion_result(messages, response_format)[0]
+
+    def _chat_completion_result(self, messages, response_format):
+        """
+        返回 (content, complete)：请求出错或输出因长度上限被截断时 complete 为 False，
+        这样的输出不写入缓存
+        """
         if not self.api_key or 'Please_Set' in self.api_key:
-            return "Error: DeepSeek API Key not configured."
-        
+            return "Error: DeepSeek API Key not configured.", False
+
+        cache_key = llm_cache.key(self.llm_model, messages, response_format is not None)
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            return cached, True
+
         try:
             response = self.client.chat.completions.create(
-                model="deepseek-chat",
+                model=self.llm_model,
                 messages=messages,
                 temperature=1.3,
-                response_format={"type": "json_object"} if json_mode else None
+                response_format=response_format
             )
-            return response.choices[0].message.content
+            choice = response.choices[0]
+            content = choice.message.content
+
+            if choice.finish_reason == 'length':
+                logger.warning("DeepSeek output truncated at max tokens, not caching")
+                return content, False
+            if content:
+                llm_cache.set(cache_key, content)
+            return content, True
         except Exception as e:
-            print(f"DeepSeek API Error: {e}")
-            return f"Error: {str(e)}"
+            logger.error("DeepSeek API Error: %s", e)
+            return f"Error: {str(e)}", False
 
     def generate_image(self, prompt):
         """
         调用 SiliconFlow 生成图片 (Flux.1 Schnell)
+        同一个 prompt 同时只会请求一次（例如一个班的学生同时问了同一个问题）
         """
-        import requests
-        print(f"DEBUG: Generating image via SiliconFlow with prompt: {prompt[:50]}...")
-        
+        key = image_cache_key(prompt)
+        cached = cache.get(key)
+        if cached:
+            return cached
+
         silicon_key = getattr(settings, 'SILICONFLOW_API_KEY', '')
         if not silicon_key or 'Please_Set' in silicon_key:
-            print("ERROR: SiliconFlow API Key not set.")
-            return "https://placehold.co/1024x1024/png?text=API+Key+Missing"
+            logger.error("SiliconFlow API Key not set.")
+            return IMAGE_KEY_MISSING_URL
+
+        with _inflight_lock:
+            future = _inflight_images.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = _inflight_images[key] = Future()
+
+        if is_owner:
+            try:
+                image_url = self._request_image(silicon_key, prompt)
+                future.set_result(image_url)
+            except BaseException as e:
+                future.set_exception(e)
+                raise
+            finally:
+                with _inflight_lock:
+                    _inflight_images.pop(key, None)
+        else:
+            image_url = future.result()
+
+        # 失败时才换成占位图：占位图不会被转存和缓存（见 core.tasks.enqueue_image_persist）
+        return image_url or IMAGE_ERROR_URL
+
+    def _request_image(self, silicon_key, prompt):
+        """
+        请求 SiliconFlow 生图，返回原始链接；失败时返回 None
+        """
+        logger.debug("Generating image via SiliconFlow with prompt: %.50s", prompt)
 
         try:
-            url = "https://api.siliconflow.cn/v1/images/generations"
-            headers = {
-                "Authorization": f"Bearer {silicon_key}",
-                "Content-Type": "application/json"
-            }
-            payload = {
-                "model": "black-forest-labs/FLUX.1-dev", # 切换到 Dev 版，质量更好
-                "prompt": prompt,
-                "image_size": "1024x1024",
-                "num_inference_steps": 20 # Dev 版推荐 20-50 步
-            }
-            
-            response = requests.post(url, json=payload, headers=headers)
+            headers, payload = self._image_request(silicon_key, prompt)
+            response = self.session.post(SILICONFLOW_IMAGE_URL, json=payload, headers=headers, timeout=HTTP_TIMEOUT)
             response.raise_for_status()
             data = response.json()
             
             # SiliconFlow 返回格式: {"data": [{"url": "..."}]}
             original_image_url = data['data'][0]['url']
-            print(f"DEBUG: Image generated via SiliconFlow: {original_image_url}")
-            
-            # 下载并保存到本地，防止链接过期
-            local_image_url = save_image_from_url(original_image_url)
-            
-            if local_image_url:
-                print(f"DEBUG: Image saved locally: {local_image_url}")
-                return local_image_url
-            else:
-                print("WARNING: Failed to save image locally, returning original URL")
-                return original_image_url
-            
+            logger.debug("Image generated via SiliconFlow: %s", original_image_url)
+
+            # 直接返回原始链接；转存到本地由调用方交给后台任务 (core.tasks.enqueue_image_persist)
+            return original_image_url
+
         except Exception as e:
-            print(f"ERROR: SiliconFlow Image Gen Error: {e}")
-            if 'response' in locals():
-                print(f"Response: {response.text}")
-            return "https://placehold.co/1024x1024/png?text=Image+Error"
+            logger.error("SiliconFlow Image Gen Error: %s", e)
+            return None
+
+    def _image_request(self, silicon_key, prompt):
+        headers = {
+            "Authorization": f"Bearer {silicon_key}",
+            "Content-Type": "application/json"
+        }
+        payload = {
+            "model": "black-forest-labs/FLUX.1-dev", # 切换到 Dev 版，质量更好
+            "prompt": prompt,
+            "image_size": "1024x1024",
+            "num_inference_steps": 20 # Dev 版推荐 20-50 步
+        }
+        return headers, payload
 
     def analyze_user_input(self, question, user_input, context_history):
         """
         分析用户输入的意图和逻辑，并按需生成 Visual Prompt
         """
-        system_prompt = """
-        You are a **Teacher's Assistant for Guided Problem Solving**. 
-        Your goal is to help a student solve a problem by guiding them through a **sequential visual narrative**.
-        
-        **CORE RULES:**
-        1. **NEVER** provide the direct final answer. If the student asks for it, refuse gently and ask a guiding question.
-        2. **VISUAL FIRST**: Instead of long text explanations, generate images or Desmos graphs that depict the **process** or **concept**.
-        3. **STEP-BY-STEP**: Break the problem down into small, manageable cognitive steps.
-        
-        Analyze the user's input and context to determine the Next Visual Scene.
-        
-        **CRITICAL STEP: Determine User Intent & Cognitive State**
-        1. **User is Clueless** ("I don't know", "No idea", "Tell me"):
-           - Action: **PROBE_DEEPER**. Do NOT generate a visual yet. Ask a simpler, foundational question to spark their intuition.
-           - Return intent="probe_deeper".
-        2. **User has a Guess/Hypothesis** (Even if wrong):
-           - Action: **VISUALIZE**. Generate a visual (Image or Desmos) to test or illustrate their guess.
-           - Return intent="has_idea".
-        3. **User is Explaining/Analyzing**:
-           - Action: **EVALUATE**. Check if their understanding is correct.
-           - If they are close to the answer, VERIFY understanding with a **Fill-in-the-Blank Challenge**.
-           - Return intent="verify_understanding".
-           - Return intent="explaining_image" if more visual steps are needed.
-           - Return intent="finish" ONLY if the entire logical chain is complete and user fully understands the final answer.
-           
-        **CRITICAL STEP: Determine Cognitive Level & Visual Tool (Only if visualizing)**
-        1. **Curiosity/Nature/Life** (e.g., "Why is sky blue?", "History"):
-           - Tool: **IMAGE_GENERATION** (Flux.1)
-           - Style: **REALISTIC, CINEMATIC, DOCUMENTARY**.
-        2. **Math/Functions/Geometry** (e.g., "y=x^2", "Parabola", "Monotonicity"):
-           - Tool: **DESMOS_CALCULATOR**
-           - Action: Generate a specific LaTeX formula.
-           - **IMPORTANT**: For concepts like "Monotonicity" or "Quadratic", do NOT just give a static formula like "y=x^2".
-           - **USE SLIDERS**: Create EXPLORATORY formulas using parameters (a, b, c).
-           - Example: Instead of "y=x^2", output "y=ax^2+bx+c". Desmos will automatically create sliders for a, b, c.
-           - Example: "y = sin(ax) + b".
-           - Goal: Allow user to manipulate the graph to discover the property.
-        3. **Academic/Abstract/Logic**:
-           - Tool: **IMAGE_GENERATION**
-           - Style: **MINIMALIST, INFOGRAPHIC**.
-
-        RETURN JSON FORMAT:
-        {
-            "intent": "has_idea" | "no_idea" | "explaining_image" | "probe_deeper" | "verify_understanding" | "finish",
-            "tool": "image_generation" | "desmos" | "fill_in_the_blank",
-            "desmos_latex": "y=ax^2+c" (Generate dynamic formulas with parameters a,b,c where possible),
-            "fill_in_the_blank": {
-                "question": "The sentence with ___ blank.",
-                "correct_answer": "answer",
-                "hint": "hint"
-            },
-            "evaluation": "pass" | "fail",
-            "feedback": "Short feedback in Chinese.",
-            "next_step_hint": "Hint if failed.",
-            "visual_prompt": "English prompt for Flux.1",
-            "visual_guide_text": "Chinese guide text."
-        }
-        """
-        messages = [
-            {"role": "system", "content": system_prompt},
+        messages = self._analyze_messages(question, user_input, context_history)
+        result, complete = self._chat_completion_result(messages, _JSON_RESPONSE_FORMAT)
+        # 解析器会跳过 ```json 围栏，无需再手动切分；被截断的输出不做补全，直接按解析失败处理
+        fields = parse_json(result) if complete else None
+        return self._analysis_result(fields, result)
+
+    def _analysis_result(self, fields, result):
+        if fields:
+            return fields
+
+        logger.warning("JSON Parse Error: no field parsed, Raw: %.200s", result)
+        return {"intent": "unknown", "feedback": "解析失败"}
+
+    def _analyze_messages(self, question, user_input, context_history):
+        return [
+            _SYSTEM_MSG_ANALYZE,
             {"role": "user", "content": f"Context History:\n{context_history}\n\nCurrent Question: {question}\nUser Input: {user_input}"}
         ]
-        
-        result = self.chat_completion(messages, json_mode=True)
-        try:
-            if "```json" in result:
-                result = result.split("```json")[1].split("```")[0]
-            elif "```" in result:
-                result = result.split("```")[1].split("```")[0]
-            return json.loads(result)
-        except Exception as e:
-            print(f"JSON Parse Error: {e}, Raw: {result}")
-            return {"intent": "unknown", "feedback": "解析失败"}
+
+    def _visual_prompt_messages(self, question, current_stage_thought):
+        return [
+            _SYSTEM_MSG_VISUAL_PROMPT,
+            {"role": "user", "content": f"Question: {question}\nCurrent Thought to Visualize: {current_stage_thought}"}
+        ]
 
     def generate_visual_prompt(self, question, current_stage_thought):
         """
         生成用于画图的 Prompt
         """
-        system_prompt = """
-        You are a Visual Thinking Expert. Convert the abstract logic into a concrete, metaphorical visual scene.
-        
-        **Determine the Subject Matter & Style:**
-        - **Nature/Real Life:** Use "Cinematic, Photorealistic, National Geographic Style".
-        - **Academic/Abstract/Logic/Math:** Use "Minimalist, Schematic, Blueprint, Infographic, Vector Art, Clean Lines, High Concept".
-        
-        OUTPUT ONLY THE VISUAL DESCRIPTION PROMPT IN ENGLISH. NO OTHER TEXT.
-        Style should be consistent with the subject matter.
-        """
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": f"Question: {question}\nCurrent Thought to Visualize: {current_stage_thought}"}
-        ]
-        return self.chat_completion(messages)
+        return self.chat_completion(self._visual_prompt_messages(question, current_stage_thought))
 
     def analyze_image_content(self, image_path, prompt):
         """
         调用 SiliconFlow Vision 模型 (Qwen2-VL) 分析图片
         """
-        import base64
-        import requests
-        
-        print(f"DEBUG: Analyzing image {image_path} via SiliconFlow...")
+        logger.debug("Analyzing image %s via SiliconFlow", image_path)
         
         silicon_key = getattr(settings, 'SILICONFLOW_API_KEY', '')
         if not silicon_key:
@@ -194,103 +355,101 @@ class DeepSeekService:
         # Encode image
         try:
             with open(image_path, "rb") as image_file:
-                encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-                image_url = f"data:image/jpeg;base64,{encoded_string}"
+                image_bytes = image_file.read()
         except Exception as e:
             return f"Error reading image: {e}"
 
+        return self.analyze_image_bytes(image_bytes, prompt)
+
+    def analyze_image_bytes(self, image_bytes, prompt):
+        """
+        直接分析内存中的图片内容（例如刚上传、还没写盘的文件）
+        """
+        silicon_key = getattr(settings, 'SILICONFLOW_API_KEY', '')
+        if not silicon_key:
+            return "Error: SiliconFlow API Key not set."
+
         try:
-            url = "https://api.siliconflow.cn/v1/chat/completions"
-            headers = {
-                "Authorization": f"Bearer {silicon_key}",
-                "Content-Type": "application/json"
-            }
-            
-            # 使用 Qwen2-VL 模型
-            model_name = "Qwen/Qwen2-VL-72B-Instruct" 
-            
-            # 增强 Prompt：不再只是描述，而是进行思维评估
-            if not prompt:
-                # 默认 Prompt 升级为苏格拉底式评估
-                analysis_prompt = """
-                你是一个苏格拉底式的思维导师。用户上传了一张图片，这很可能是一道题目（选择题、填空题等），或者他的手写草稿。
-                
-                **你的核心宗旨：培养用户的独立思考能力。**
-                
-                你的任务：
-                1. **识别题目/内容**：简单确认你看到了什么题目或内容（证明你看懂了）。
-                2. **绝不直接给答案**：无论题目多简单，都严禁直接给出选项或结果。
-                3. **启发式引导**：
-                   - 如果是题目，请分析解题的关键突破口，反问用户是否注意到了某个条件。
-                   - 如果是草稿，指出其思路中的亮点或盲点。
-                
-                请用**简短、口语化**的语气（100字以内）回复：
-                "我看到了这道关于...的题。你觉得解这道题的关键是什么？是...吗？" 类似的引导风格。
-                """
-            else:
-                # 如果用户提供了文字说明，结合文字进行评估
-                analysis_prompt = f"""
-                用户上传了一张图片（可能是题目），并附言："{prompt}"。
-                
-                **你的核心宗旨：培养用户的独立思考能力。**
-                
-                你的任务：
-                1. 结合图片和附言，理解用户的困惑点。
-                2. **绝不直接给答案**。
-                3. **引导思考**：针对用户的疑问，给出一个思维脚手架（Scaffolding），引导他自己迈出下一步。
-                
-                请用**简短、口语化**的语气（100字以内）回复。
-                """
-
-            payload = {
-                "model": model_name, 
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "image_url", "image_url": {"url": image_url}},
-                            {"type": "text", "text": analysis_prompt}
-                        ]
-                    }
-                ],
-                "max_tokens": 1024
-            }
-            
-            response = requests.post(url, json=payload, headers=headers)
+            headers, payload = self._vision_request(silicon_key, image_bytes, prompt)
+            response = self.session.post(SILICONFLOW_CHAT_URL, json=payload, headers=headers, timeout=HTTP_TIMEOUT)
             
             if response.status_code != 200:
-                print(f"WARNING: Vision API failed with {model_name}, trying 7B...")
-                payload["model"] = "Qwen/Qwen2-VL-7B-Instruct"
-                response = requests.post(url, json=payload, headers=headers)
+                logger.warning("Vision API failed with %s, trying 7B", payload["model"])
+                payload["model"] = VISION_FALLBACK_MODEL
+                response = self.session.post(SILICONFLOW_CHAT_URL, json=payload, headers=headers, timeout=HTTP_TIMEOUT)
 
             response.raise_for_status()
             result = response.json()
             return result['choices'][0]['message']['content']
             
         except Exception as e:
-            print(f"ERROR: SiliconFlow Vision Error: {e}")
-            if 'response' in locals():
-                print(f"Response: {response.text}")
+            logger.error("SiliconFlow Vision Error: %s", e)
             return f"图片分析失败: {str(e)}"
 
+    def _vision_request(self, silicon_key, image_bytes, prompt):
+        encoded_string = base64.b64encode(image_bytes).decode('utf-8')
+        image_url = f"data:image/jpeg;base64,{encoded_string}"
+
+        headers = {
+            "Authorization": f"Bearer {silicon_key}",
+            "Content-Type": "application/json"
+        }
+        
+        # 增强 Prompt：不再只是描述，而是进行思维评估
+        if not prompt:
+            # 默认 Prompt 升级为苏格拉底式评估
+            analysis_prompt = _IMAGE_ANALYSIS_PROMPT
+        else:
+            # 如果用户提供了文字说明，结合文字进行评估
+            analysis_prompt = _IMAGE_ANALYSIS_WITH_TEXT_PROMPT.format(prompt=prompt)
+
+        payload = {
+            "model": VISION_MODEL, 
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "image_url", "image_url": {"url": image_url}},
+                        {"type": "text", "text": analysis_prompt}
+                    ]
+                }
+            ],
+            "max_tokens": 1024
+        }
+        return headers, payload
+
     def generate_initial_probe(self, user_question):
         """
-        生成个性化的初始引导语
-        """
-        system_prompt = """
-        你是一个苏格拉底式的思维导师。用户刚提出了一个问题。
-        你的任务是：
-        1. 确认收到问题。
-        2. 询问用户目前对这个问题是否有初步的直觉或想法。
-        
-        要求：
-        - 语气温暖、专业、具有同理心。
-        - 必须包含“初步想法”或“直觉”这个核心询问点。
-        - 不要直接回答问题，而是引导用户开始思考。
-        - 100字以内。
+        生成初始引导语
+        默认按问题类别返回预置话术（开场白意图固定，不值得一次 LLM 往返），
+        设置 USE_LLM_PROBE 后改为调用 LLM 生成个性化引导语
         """
-        messages = [
-            {"role": "system", "content": system_prompt},
+        if not getattr(settings, 'USE_LLM_PROBE', False):
+            return random.choice(_INITIAL_PROBES[_probe_category(user_question)])
+        return self.chat_completion(self._initial_probe_messages(user_question))
+
+    def _initial_probe_messages(self, user_question):
+        return [
+            _SYSTEM_MSG_INITIAL_PROBE,
             {"role": "user", "content": f"User Question: {user_question}"}
         ]
-        return self.chat_completion(messages)
+
+
+def _probe_category(user_question):
+    """
+    用关键词粗略判断问题类别，匹配不到时归为 general
+    """
+    text = user_question or ''
+    for category, keywords in _PROBE_KEYWORDS:
+        if any(word in text for word in keywords):
+            return category
+    return 'general'
+
+
+@functools.lru_cache(maxsize=1)
+def get_service():
+    """
+    进程内共享的 DeepSeekService 实例（首次使用时创建），
+    让 HTTP 连接池在请求之间复用，避免每个请求重新建连
+    """
+    return DeepSeekService()
@@ -1,8 +1,12 @@
+import logging
 import requests
 import json
 import time
 import random
 from django.conf import settings
+from core.utils import HTTP_TIMEOUT, create_http_session
+
+logger = logging.getLogger(__name__)
 
 class DifyService:
     def __init__(self):
@@ -12,6 +16,7 @@ class DifyService:
             'Authorization': f'Bearer {self.api_key}',
             'Content-Type': 'application/json'
         }
+        self.session = create_http_session()
 
     def send_message(self, query, user_id, conversation_id=None, inputs=None):
         """
@@ -31,11 +36,11 @@ class DifyService:
         }
 
         try:
-            response = requests.post(url, headers=self.headers, json=payload)
+            response = self.session.post(url, headers=self.headers, json=payload, timeout=HTTP_TIMEOUT)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.RequestException as e:
-            print(f"Error communicating with Dify: {e}")
+            logger.error("Error communicating with Dify: %s", e)
             # Fallback to mock if API fails (for demo purposes)
             return self._mock_response(query, conversation_id)
 
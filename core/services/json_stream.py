@@ -0,0 +1,210 @@
+import json
+
+# 模型偶尔会输出 Python 风格的字面量
+_PY_LITERALS = {'True': 'true', 'False': 'false', 'None': 'null'}
+_CLOSERS = {'{': '}', '[': ']'}
+
+
+class PartialJSONParser:
+    """
+    增量 JSON 解析器：边接收流式输出边扫描，每个字符只扫描一次 (O(n))。
+    只关心最外层对象的字段，结果在 fields 中。
+    会忽略第一个 "{" 之前和最后一个 "}" 之后的内容（例如 ```json 代码块围栏），
+    并容忍尾逗号、True/False/None 以及被截断的输出（见 finish）。
+    """
+
+    def __init__(self):
+        self.fields = {}
+        self.started = False
+        self.done = False
+
+        self._state = 'key'     # key / key_string / colon / value / after_value
+        self._key_chars = []
+        self._key = None
+        self._value_chars = []
+        self._value_kind = None  # string / container / literal
+        self._stack = []         # 值内部尚未闭合的括号（仅 container 使用）
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, text):
+        for ch in text:
+            if self.done:
+                return
+            if not self.started:
+                if ch == '{':
+                    self.started = True
+                continue
+            self._consume(ch)
+
+    def finish(self):
+        """
+        流结束时调用：如果输出被截断，补全最后一个字段的引号/括号后尽量保留它
+        """
+        if self.started and not self.done and self._state == 'value' and self._value_kind:
+            if self._in_string:
+                if self._escape:
+                    self._value_chars.pop()
+                self._value_chars.append('"')
+            self._value_chars.extend(_CLOSERS[c] for c in reversed(self._stack))
+            self._close_value()
+        return self.fields
+
+    def _consume(self, ch):
+        state = self._state
+
+        if state == 'key':
+            if ch == '"':
+                self._state = 'key_string'
+                self._key_chars = []
+            elif ch == '}':
+                self.done = True
+            # 其余字符（空白、逗号）直接跳过，因此尾逗号不影响解析
+            return
+
+        if state == 'key_string':
+            if self._escape:
+                self._escape = False
+            elif ch == '\\':
+                self._escape = True
+            elif ch == '"':
+                self._key = _loads('"' + ''.join(self._key_chars) + '"')
+                self._state = 'colon'
+                return
+            self._key_chars.append(ch)
+            return
+
+        if state == 'colon':
+            if ch == ':':
+                self._state = 'value'
+                self._value_chars = []
+                self._value_kind = None
+            return
+
+        if state == 'value':
+            if self._value_kind is None:
+                if ch.isspace():
+                    return
+                self._value_chars.append(ch)
+                if ch == '"':
+                    self._value_kind = 'string'
+                    self._in_string = True
+                elif ch in '{[':
+                    self._value_kind = 'container'
+                    self._stack = [ch]
+                else:
+                    self._value_kind = 'literal'
+                return
+
+            if self._value_kind == 'literal':
+                if ch in ',}' or ch.isspace():
+                    self._close_value()
+                    if ch == ',':
+                        self._state = 'key'
+                    elif ch == '}':
+                        self.done = True
+                    return
+                self._value_chars.append(ch)
+                return
+
+            self._value_chars.append(ch)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._value_kind == 'string':
+                        self._close_value()
+                return
+
+            if ch == '"':
+                self._in_string = True
+            elif ch in '{[':
+                self._stack.append(ch)
+            elif ch in '}]':
+                self._stack.pop()
+                if not self._stack:
+                    self._close_value()
+            return
+
+        if state == 'after_value':
+            if ch == ',':
+                self._state = 'key'
+            elif ch == '}':
+                self.done = True
+
+    def _close_value(self):
+        self._state = 'after_value'
+        self._in_string = False
+        self._escape = False
+        if self._key is None:
+            return
+        try:
+            value = _loads(''.join(self._value_chars))
+        except ValueError:
+            return
+        self.fields[self._key] = value
+
+
+def parse_json(text):
+    """
+    容错解析模型返回的 JSON 对象（可带代码块围栏、尾逗号、Python 字面量，或被截断）
+    一个字段都解析不出来时返回 None
+    """
+    parser = PartialJSONParser()
+    parser.feed(text or '')
+    fields = parser.finish()
+    if parser.done or fields:
+        return fields
+    return None
+
+
+def _loads(raw):
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return json.loads(_repair(raw))
+
+
+def _repair(raw):
+    """
+    单次扫描修正常见的不合法写法：去掉 } / ] 之前的尾逗号，把 True/False/None 换成 JSON 字面量
+    """
+    out = []
+    word = []
+    in_string = False
+    escape = False
+    for ch in raw:
+        if in_string:
+            out.append(ch)
+            if escape:
+                escape = False
+            elif ch == '\\':
+                escape = True
+            elif ch == '"':
+                in_string = False
+            continue
+
+        if ch.isalpha():
+            word.append(ch)
+            continue
+        if word:
+            w = ''.join(word)
+            out.append(_PY_LITERALS.get(w, w))
+            word = []
+
+        if ch == '"':
+            in_string = True
+        elif ch in '}]':
+            while out and out[-1].isspace():
+                out.pop()
+            if out and out[-1] == ',':
+                out.pop()
+        out.append(ch)
+
+    if word:
+        w = ''.join(word)
+        out.append(_PY_LITERALS.get(w, w))
+    return ''.join(out)
@@ -0,0 +1,34 @@
+import hashlib
+import orjson
+from django.core.cache import cache
+
+# 缓存有效期（秒）
+DEFAULT_TTL = 3600
+
+
+class LLMCache:
+    """
+    LLM 响应的精确匹配缓存
+    相同的 (model, messages, json_mode) 直接返回上一次的结果，不再请求远端 API
+    (例如重试最后一条消息、老师反复演示同一道题)
+    """
+
+    def __init__(self, prefix='llm', ttl=DEFAULT_TTL):
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def key(self, model, messages, json_mode=False):
+        raw = orjson.dumps(
+            {"model": model, "messages": messages, "json_mode": json_mode},
+            option=orjson.OPT_SORT_KEYS
+        )
+        return f"{self.prefix}:{hashlib.sha256(raw).hexdigest()}"
+
+    def get(self, key):
+        return cache.get(key)
+
+    def set(self, key, content):
+        cache.set(key, content, self.ttl)
+
+
+llm_cache = LLMCache()
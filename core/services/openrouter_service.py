@@ -1,7 +1,51 @@
-import json
+import functools
+import logging
 import requests
+import urllib.parse
 from django.conf import settings
 from openai import OpenAI
+from core.utils import create_openai_http_client
+from core.services.ai_cache import IMAGE_ERROR_URL
+from core.services.json_stream import parse_json
+from core.services.llm_cache import llm_cache
+
+logger = logging.getLogger(__name__)
+
+_JSON_RESPONSE_FORMAT = {"type": "json_object"}
+
+OPENROUTER_EXTRA_HEADERS = {
+    "HTTP-Referer": "https://thinkfirst.app", # OpenRouter 要求
+    "X-Title": "ThinkFirst"
+}
+
+_SYSTEM_PROMPT_ANALYZE = """
+You are a Socratic Tutor. Analyze the user's input based on the question and context.
+
+Determine if the user:
+1. "has_idea": Provided a specific thought/idea about the question.
+2. "no_idea": Said they don't know or have no idea.
+3. "explaining_image": Is interpreting the AI-generated image shown to them.
+
+If "explaining_image", evaluate if their interpretation makes logical sense or connects to the core problem (pass/fail).
+
+Return JSON:
+{
+    "intent": "has_idea" | "no_idea" | "explaining_image",
+    "evaluation": "pass" | "fail" (only if explaining_image),
+    "feedback": "Short feedback in Chinese",
+    "next_step_hint": "Hint if failed, in Chinese"
+}
+"""
+_SYSTEM_MSG_ANALYZE = {"role": "system", "content": _SYSTEM_PROMPT_ANALYZE}
+
+_SYSTEM_PROMPT_VISUAL_PROMPT = """
+You are a Visual Thinking Expert. Convert the abstract logic into a concrete, metaphorical visual scene.
+
+OUTPUT ONLY THE VISUAL DESCRIPTION PROMPT IN ENGLISH. NO OTHER TEXT.
+
+Style: Surrealist, Minimalist, Metaphorical. High quality, 8k resolution.
+"""
+_SYSTEM_MSG_VISUAL_PROMPT = {"role": "system", "content": _SYSTEM_PROMPT_VISUAL_PROMPT}
 
 class OpenRouterService:
     def __init__(self):
@@ -9,7 +53,8 @@ class OpenRouterService:
         # OpenRouter 兼容 OpenAI SDK
         self.client = OpenAI(
             api_key=self.api_key,
-            base_url="https://openrouter.ai/api/v1"
+            base_url="https://openrouter.ai/api/v1",
+            http_client=create_openai_http_client()
         )
         # 模型配置
         # 使用 Google Gemini 2.0 Flash (目前在 OpenRouter 上免费/极低成本)
@@ -17,103 +62,117 @@ class OpenRouterService:
         # 生图模型：Flux 1 Schnell
         self.image_model = "black-forest-labs/flux-1-schnell"
 
-    def chat_completion(self, messages, json_mode=False):
+    def chat_completion(self, messages):
         """
         调用 LLM 进行对话或逻辑判断
         """
-        print(f"DEBUG: Calling OpenRouter LLM with model {self.llm_model}...")
-        extra_headers = {
-            "HTTP-Referer": "https://thinkfirst.app", # OpenRouter 要求
-            "X-Title": "ThinkFirst"
-        }
-        
+        return self._chat_completion(messages, None)
+
+    def chat_completion_json(self, messages):
+        """
+        JSON 模式 (response_format=json_object) 的 chat_completion
+        """
+        return self._chat_completion(messages, _JSON_RESPONSE_FORMAT)
+
+    def _chat_completion(self, messages, response_format):
+        return self._chat_completion_result(messages, response_format)[0]
+
+    def _chat_completion_result(self, messages, response_format):
+        """
+        返回 (content, complete)：请求出错或输出因长度上限被截断时 complete 为 False，
+        这样的输出不写入缓存
+        """
+        cache_key = llm_cache.key(self.llm_model, messages, response_format is not None)
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            return cached, True
+
+        logger.debug("Calling OpenRouter LLM with model %s", self.llm_model)
         try:
             response = self.client.chat.completions.create(
                 model=self.llm_model,
                 messages=messages,
-                response_format={"type": "json_object"} if json_mode else None,
+                response_format=response_format,
                 temperature=0.7,
-                extra_headers=extra_headers
+                extra_headers=OPENROUTER_EXTRA_HEADERS
             )
-            content = response.choices[0].message.content
-            print(f"DEBUG: LLM Response: {content[:100]}...")
-            return content
+            choice = response.choices[0]
+            content = choice.message.content
+            logger.debug("LLM Response: %.100s", content)
+            if choice.finish_reason == 'length':
+                logger.warning("OpenRouter output truncated at max tokens, not caching")
+                return content, False
+            if content:
+                llm_cache.set(cache_key, content)
+            return content, True
         except Exception as e:
-            print(f"ERROR: OpenRouter LLM Error: {e}")
-            return None
+            logger.error("OpenRouter LLM Error: %s", e)
+            return None, False
 
     def generate_image(self, prompt):
         """
         调用 Pollinations.ai 生成图片 (免费、无需Key、稳定)
         """
-        import urllib.parse
-        print(f"DEBUG: Generating image with prompt: {prompt[:50]}...")
+        logger.debug("Generating image with prompt: %.50s", prompt)
         try:
-            # Pollinations.ai API: https://image.pollinations.ai/prompt/{prompt}
-            # 需要对 prompt 进行 URL 编码
-            encoded_prompt = urllib.parse.quote(prompt)
-            # 添加一些参数以增强效果，例如 seed (虽然 pollinations 默认随机)
-            # nologo=true 去除水印
-            url = f"https://image.pollinations.ai/prompt/{encoded_prompt}?nologo=true&width=1024&height=1024&model=flux"
-            
-            print(f"DEBUG: Image generated via Pollinations: {url}")
+            url = _pollinations_url(prompt)
+            logger.debug("Image generated via Pollinations: %s", url)
             return url
         except Exception as e:
-            print(f"ERROR: Image Gen Error: {e}")
-            return "https://placehold.co/1024x1024/png?text=Image+Error"
+            logger.error("Image Gen Error: %s", e)
+            return IMAGE_ERROR_URL
 
     def analyze_user_input(self, question, user_input, context_history):
         """
         分析用户输入的意图和逻辑
         """
-        system_prompt = """
-        You are a Socratic Tutor. Analyze the user's input based on the question and context.
-        
-        Determine if the user:
-        1. "has_idea": Provided a specific thought/idea about the question.
-        2. "no_idea": Said they don't know or have no idea.
-        3. "explaining_image": Is interpreting the AI-generated image shown to them.
-        
-        If "explaining_image", evaluate if their interpretation makes logical sense or connects to the core problem (pass/fail).
-        
-        Return JSON:
-        {
-            "intent": "has_idea" | "no_idea" | "explaining_image",
-            "evaluation": "pass" | "fail" (only if explaining_image),
-            "feedback": "Short feedback in Chinese",
-            "next_step_hint": "Hint if failed, in Chinese"
-        }
-        """
-        messages = [
-            {"role": "system", "content": system_prompt},
+        messages = self._analyze_messages(question, user_input, context_history)
+        result, complete = self._chat_completion_result(messages, _JSON_RESPONSE_FORMAT)
+        # 有些模型可能返回 markdown code block，解析器会自动跳过围栏；被截断的输出不做补全，直接按解析失败处理
+        fields = parse_json(result) if complete else None
+        return self._analysis_result(fields, result)
+
+    def _analysis_result(self, fields, result):
+        if fields:
+            return fields
+
+        logger.warning("JSON Parse Error: no field parsed, Raw: %.200s", result)
+        return {"intent": "unknown", "feedback": "解析失败"}
+
+    def _analyze_messages(self, question, user_input, context_history):
+        return [
+            _SYSTEM_MSG_ANALYZE,
             {"role": "user", "content": f"Context History:\n{context_history}\n\nCurrent Question: {question}\nUser Input: {user_input}"}
         ]
-        
-        result = self.chat_completion(messages, json_mode=True)
-        try:
-            # 有些模型可能返回 markdown code block，需要清洗
-            if "```json" in result:
-                result = result.split("```json")[1].split("```")[0]
-            elif "```" in result:
-                result = result.split("```")[1].split("```")[0]
-            return json.loads(result)
-        except Exception as e:
-            print(f"JSON Parse Error: {e}, Raw: {result}")
-            return {"intent": "unknown", "feedback": "解析失败"}
+
+    def _visual_prompt_messages(self, question, current_stage_thought):
+        return [
+            _SYSTEM_MSG_VISUAL_PROMPT,
+            {"role": "user", "content": f"Question: {question}\nCurrent Thought to Visualize: {current_stage_thought}"}
+        ]
 
     def generate_visual_prompt(self, question, current_stage_thought):
         """
         生成用于画图的 Prompt
         """
-        system_prompt = """
-        You are a Visual Thinking Expert. Convert the abstract logic into a concrete, metaphorical visual scene.
-        
-        OUTPUT ONLY THE VISUAL DESCRIPTION PROMPT IN ENGLISH. NO OTHER TEXT.
-        
-        Style: Surrealist, Minimalist, Metaphorical. High quality, 8k resolution.
-        """
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": f"Question: {question}\nCurrent Thought to Visualize: {current_stage_thought}"}
-        ]
-        return self.chat_completion(messages)
+        return self.chat_completion(self._visual_prompt_messages(question, current_stage_thought))
+
+@functools.lru_cache(maxsize=1024)
+def _pollinations_url(prompt):
+    """
+    Pollinations 的图片地址只由 prompt 和固定参数决定，相同 prompt 直接复用拼好的 URL
+    """
+    # Pollinations.ai API: https://image.pollinations.ai/prompt/{prompt}
+    # prompt 需要完整 URL 编码（包括 "/"，否则会被当成路径分隔符）
+    encoded_prompt = urllib.parse.quote_from_bytes(prompt.encode('utf-8'), safe='')
+    # nologo=true 去除水印
+    return f"https://image.pollinations.ai/prompt/{encoded_prompt}?nologo=true&width=1024&height=1024&model=flux"
+
+
+@functools.lru_cache(maxsize=1)
+def get_service():
+    """
+    进程内共享的 OpenRouterService 实例（首次使用时创建），
+    让 HTTP 连接池在请求之间复用，避免每个请求重新建连
+    """
+    return OpenRouterService()
@@ -1,34 +1,98 @@
-import json
+import functools
+import logging
 import requests
 from django.conf import settings
 from openai import OpenAI
+from core.utils import create_openai_http_client
+from core.services.json_stream import parse_json
+from core.services.llm_cache import llm_cache
+
+logger = logging.getLogger(__name__)
+
+_JSON_RESPONSE_FORMAT = {"type": "json_object"}
+
+_SYSTEM_PROMPT_ANALYZE = """
+你是一个思维导师。你需要分析用户的输入。
+根据当前的问题和历史，判断用户的输入是：
+1. 提供了具体的想法 (has_idea)
+2. 表示不知道/没有想法 (no_idea)
+3. 正在尝试解释图片 (explaining_image)
+
+如果是在解释图片，请评估其解释是否合理（pass/fail），并给出 feedback。
+
+请以 JSON 格式返回：
+{
+    "intent": "has_idea" | "no_idea" | "explaining_image",
+    "evaluation": "pass" | "fail" (仅在 explaining_image 时有效),
+    "feedback": "简短的反馈",
+    "next_step_hint": "如果失败，给出的提示"
+}
+"""
+_SYSTEM_MSG_ANALYZE = {"role": "system", "content": _SYSTEM_PROMPT_ANALYZE}
+
+_SYSTEM_PROMPT_VISUAL_PROMPT = """
+你是一个视觉思维专家。你需要将一个抽象的逻辑点转化为一个具体的、极具隐喻性的视觉场景。
+生成的 Prompt 必须是英文。
+不要包含文字解释，只描述画面。
+画面风格应该是：超现实主义、极简主义、充满隐喻。
+"""
+_SYSTEM_MSG_VISUAL_PROMPT = {"role": "system", "content": _SYSTEM_PROMPT_VISUAL_PROMPT}
 
 class SiliconFlowService:
     def __init__(self):
         self.api_key = getattr(settings, 'SILICONFLOW_API_KEY', '')
         self.client = OpenAI(
             api_key=self.api_key,
-            base_url="https://api.siliconflow.cn/v1"
+            base_url="https://api.siliconflow.cn/v1",
+            http_client=create_openai_http_client()
         )
         # 模型配置
         self.llm_model = "Qwen/Qwen2.5-72B-Instruct"  # 或 deepseek-ai/DeepSeek-V3
         self.image_model = "black-forest-labs/FLUX.1-schnell"
 
-    def chat_completion(self, messages, json_mode=False):
+    def chat_completion(self, messages):
         """
         调用 LLM 进行对话或逻辑判断
         """
+        return self._chat_completion(messages, None)
+
+    def chat_completion_json(self, messages):
+        """
+        JSON 模式 (response_format=json_object) 的 chat_completion
+        """
+        return self._chat_completion(messages, _JSON_RESPONSE_FORMAT)
+
+    def _chat_completion(self, messages, response_format):
+        return self._chat_completion_result(messages, response_format)[0]
+
+    def _chat_completion_result(self, messages, response_format):
+        """
+        返回 (content, complete)：请求出错或输出因长度上限被截断时 complete 为 False，
+        这样的输出不写入缓存
+        """
+        cache_key = llm_cache.key(self.llm_model, messages, response_format is not None)
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            return cached, True
+
         try:
             response = self.client.chat.completions.create(
                 model=self.llm_model,
                 messages=messages,
-                response_format={"type": "json_object"} if json_mode else None,
+                response_format=response_format,
                 temperature=0.7
             )
-            return response.choices[0].message.content
+            choice = response.choices[0]
+            content = choice.message.content
+            if choice.finish_reason == 'length':
+                logger.warning("SiliconFlow output truncated at max tokens, not caching")
+                return content, False
+            if content:
+                llm_cache.set(cache_key, content)
+            return content, True
         except Exception as e:
-            print(f"SiliconFlow LLM Error: {e}")
-            return None
+            logger.error("SiliconFlow LLM Error: %s", e)
+            return None, False
 
     def generate_image(self, prompt):
         """
@@ -44,53 +108,43 @@ class SiliconFlowService:
             # SiliconFlow 返回的是 url
             return response.data[0].url
         except Exception as e:
-            print(f"SiliconFlow Image Gen Error: {e}")
+            logger.error("SiliconFlow Image Gen Error: %s", e)
             return None
 
     def analyze_user_input(self, question, user_input, context_history):
         """
         分析用户输入的意图和逻辑
         """
-        system_prompt = """
-        你是一个思维导师。你需要分析用户的输入。
-        根据当前的问题和历史，判断用户的输入是：
-        1. 提供了具体的想法 (has_idea)
-        2. 表示不知道/没有想法 (no_idea)
-        3. 正在尝试解释图片 (explaining_image)
-        
-        如果是在解释图片，请评估其解释是否合理（pass/fail），并给出 feedback。
-        
-        请以 JSON 格式返回：
-        {
-            "intent": "has_idea" | "no_idea" | "explaining_image",
-            "evaluation": "pass" | "fail" (仅在 explaining_image 时有效),
-            "feedback": "简短的反馈",
-            "next_step_hint": "如果失败，给出的提示"
-        }
-        """
-        messages = [
-            {"role": "system", "content": system_prompt},
+        messages = self._analyze_messages(question, user_input, context_history)
+        result, complete = self._chat_completion_result(messages, _JSON_RESPONSE_FORMAT)
+        # 被截断的输出不做补全，直接按解析失败处理
+        fields = parse_json(result) if complete else None
+        if fields:
+            return fields
+        return {"intent": "unknown", "feedback": "解析失败"}
+
+    def _analyze_messages(self, question, user_input, context_history):
+        return [
+            _SYSTEM_MSG_ANALYZE,
             {"role": "user", "content": f"Context: {context_history}\nQuestion: {question}\nUser Input: {user_input}"}
         ]
-        
-        result = self.chat_completion(messages, json_mode=True)
-        try:
-            return json.loads(result)
-        except:
-            return {"intent": "unknown", "feedback": "解析失败"}
+
+    def _visual_prompt_messages(self, question, current_stage_thought):
+        return [
+            _SYSTEM_MSG_VISUAL_PROMPT,
+            {"role": "user", "content": f"Question: {question}\nCurrent Thought: {current_stage_thought}\nGenerate a visual prompt for this thought."}
+        ]
 
     def generate_visual_prompt(self, question, current_stage_thought):
         """
         基于当前思维阶段，生成用于画图的 Prompt
         """
-        system_prompt = """
-        你是一个视觉思维专家。你需要将一个抽象的逻辑点转化为一个具体的、极具隐喻性的视觉场景。
-        生成的 Prompt 必须是英文。
-        不要包含文字解释，只描述画面。
-        画面风格应该是：超现实主义、极简主义、充满隐喻。
-        """
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": f"Question: {question}\nCurrent Thought: {current_stage_thought}\nGenerate a visual prompt for this thought."}
-        ]
-        return self.chat_completion(messages)
+        return self.chat_completion(self._visual_prompt_messages(question, current_stage_thought))
+
+@functools.lru_cache(maxsize=1)
+def get_service():
+    """
+    进程内共享的 SiliconFlowService 实例（首次使用时创建），
+    让 HTTP 连接池在请求之间复用，避免每个请求重新建连
+    """
+    return SiliconFlowService()
@@ -0,0 +1,104 @@
+import logging
+import orjson
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from django.core.cache import cache
+from django.db import connection, transaction
+from .models import Interaction
+from .services.ai_cache import IMAGE_CACHE_TTL, PLACEHOLDER_IMAGE_URLS, image_cache_key
+from .utils import save_image_from_url
+
+logger = logging.getLogger(__name__)
+
+# 后台线程池：执行不需要阻塞本次响应的副作用（例如把 AI 生成的图片转存到本地）
+_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix='thinkfirst-bg')
+# 两个队列：文本队列处理整条消息（分析意图、追问），生图队列只负责生成图片并写库
+# 生图一次要十几秒，分开后慢的生图任务不会占满处理文本的线程
+_CHAT_EXECUTOR = ThreadPoolExecutor(max_workers=32, thread_name_prefix='thinkfirst-chat')
+_IMAGE_EXECUTOR = ThreadPoolExecutor(max_workers=16, thread_name_prefix='thinkfirst-image')
+
+# 后台处理的消息结果在缓存里保留多久（秒）
+CHAT_JOB_TTL = 600
+
+def persist_interaction_image(interaction_id, image_url, prompt=None):
+    """
+    下载 AI 生成的图片到本地，并把 Interaction.image_url 换成本地地址，防止原链接过期
+    本地地址同时按 prompt 写入缓存，之后相同 prompt 直接复用
+    """
+    try:
+        local_image_url = save_image_from_url(image_url)
+        if local_image_url:
+            # 只替换仍然指向原链接的记录（期间可能已被回滚删除）
+            Interaction.objects.filter(id=interaction_id, image_url=image_url).update(image_url=local_image_url)
+            if prompt:
+                cache.set(image_cache_key(prompt), local_image_url, IMAGE_CACHE_TTL)
+        else:
+            logger.warning("Failed to save image locally, keeping original URL: %s", image_url)
+    finally:
+        # 后台线程自己的数据库连接，用完即关
+        connection.close()
+
+def enqueue_image_persist(interaction_id, image_url, prompt=None):
+    """
+    在事务提交后把图片转存任务交给后台线程，接口直接返回原始 URL
+    生图失败时的占位图不转存，否则会被当成这个 prompt 的图片缓存下来
+    """
+    if not image_url or not image_url.startswith('http') or image_url in PLACEHOLDER_IMAGE_URLS:
+        return
+    transaction.on_commit(lambda: _EXECUTOR.submit(persist_interaction_image, interaction_id, image_url, prompt))
+
+def _run_and_close_connection(func, *args):
+    try:
+        return func(*args)
+    finally:
+        connection.close()
+
+def run_image_task(func, *args):
+    """
+    在后台线程执行 func(*args)（生成图片并写库），返回 Future
+    """
+    return _IMAGE_EXECUTOR.submit(_run_and_close_connection, func, *args)
+
+def chat_job_key(job_id):
+    return f"chat-job:{job_id}"
+
+def submit_chat_job(user_id, handler, *args):
+    """
+    把一条消息交给文本队列处理，立即返回 job_id
+    handler(*args) 返回的响应（JSON 或 SSE）被折算成结果字典写进缓存，前端按 job_id 轮询
+    """
+    job_id = uuid.uuid4().hex
+    cache.set(chat_job_key(job_id), {'status': 'pending', 'done': False, 'user_id': user_id}, CHAT_JOB_TTL)
+    _CHAT_EXECUTOR.submit(_run_and_close_connection, _run_chat_job, job_id, user_id, handler, *args)
+    return job_id
+
+def get_chat_job(job_id, user_id):
+    """
+    查询后台消息的处理结果；不存在、已过期或不属于该用户时返回 None
+    """
+    job = cache.get(chat_job_key(job_id))
+    if not job or job.get('user_id') != user_id:
+        return None
+    return {k: v for k, v in job.items() if k != 'user_id'}
+
+def _run_chat_job(job_id, user_id, handler, *args):
+    key = chat_job_key(job_id)
+    result = {'user_id': user_id}
+    try:
+        response = handler(*args)
+        if response.streaming:
+            # SSE：每推送一个事件就更新一次结果，文字先到，图片 URL 后到
+            try:
+                for chunk in response.streaming_content:
+                    for frame in chunk.split(b"\n\n"):
+                        if frame.startswith(b"data: "):
+                            result.update(orjson.loads(frame[len(b"data: "):]))
+                            cache.set(key, {**result, 'done': False}, CHAT_JOB_TTL)
+            finally:
+                response.close()
+        else:
+            result.update(orjson.loads(response.content))
+    except Exception as e:
+        logger.exception("Chat job %s failed", job_id)
+        result.update(status='error', message=str(e))
+    cache.set(key, {**result, 'done': True}, CHAT_JOB_TTL)
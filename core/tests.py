@@ -1,3 +1,571 @@
-from django.test import TestCase
+import importlib
+import threading
+from concurrent.futures import Future
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import orjson
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.http import HttpResponse
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from .models import Classroom, Conversation, Interaction
+from .services import deepseek_service
+from .services.ai_cache import IMAGE_ERROR_URL, IMAGE_KEY_MISSING_URL, image_cache_key
+from .services.json_stream import PartialJSONParser, parse_json
+from .services.openrouter_service import OpenRouterService
+from .tasks import enqueue_image_persist, persist_interaction_image, submit_chat_job
+from .views_helper import (
+    CHAT_CONVERSATION_FIELDS, RELATIVITY_CHALLENGE, RELATIVITY_FINAL_REVIEW, RELATIVITY_SCRIPT,
+    ConcurrentTurnError, _DISCARDED_MESSAGE, _cached_image, _demo_image_urls, _handle_chat_response,
+    _image_reply, _recent_interactions, _save_turn, recent_interactions_prefetch, run_locked,
+)
+
+
+@override_settings(DEEPSEEK_API_KEY='sk-test', SILICONFLOW_API_KEY='sk-test')
+class GenerateImageTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.service = deepseek_service.DeepSeekService()
+
+    def test_concurrent_identical_prompts_share_one_request(self):
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def request_image(key, prompt):
+            calls.append(prompt)
+            started.set()
+            release.wait(5)
+            return 'https://cdn.example.com/a.png'
+
+        results = []
+        with mock.patch.object(self.service, '_request_image', side_effect=request_image):
+            owner = threading.Thread(target=lambda: results.append(self.service.generate_image('p')))
+            owner.start()
+            started.wait(5)
+            waiters = [threading.Thread(target=lambda: results.append(self.service.generate_image('p'))) for _ in range(3)]
+            for t in waiters:
+                t.start()
+            release.set()
+            for t in [owner, *waiters]:
+                t.join(5)
+
+        self.assertEqual(calls, ['p'])
+        self.assertEqual(results, ['https://cdn.example.com/a.png'] * 4)
+
+    def test_cached_local_url_skips_provider(self):
+        cache.set(image_cache_key('p'), '/media/ai_images/p.png')
+        with mock.patch.object(self.service, '_request_image') as request_image:
+            self.assertEqual(self.service.generate_image('p'), '/media/ai_images/p.png')
+        request_image.assert_not_called()
+
+    def test_failed_request_returns_placeholder(self):
+        with mock.patch.object(self.service, '_request_image', return_value=None):
+            self.assertEqual(self.service.generate_image('p'), IMAGE_ERROR_URL)
+
+    @override_settings(SILICONFLOW_API_KEY='')
+    def test_missing_key_returns_placeholder_without_request(self):
+        with mock.patch.object(self.service, '_request_image') as request_image:
+            self.assertEqual(self.service.generate_image('p'), IMAGE_KEY_MISSING_URL)
+        request_image.assert_not_called()
+
+    def test_placeholders_are_not_persisted(self):
+        with mock.patch('core.tasks.transaction.on_commit') as on_commit:
+            enqueue_image_persist(1, IMAGE_ERROR_URL, 'p')
+            enqueue_image_persist(1, IMAGE_KEY_MISSING_URL, 'p')
+        on_commit.assert_not_called()
+
+
+@override_settings(DEEPSEEK_API_KEY='sk-test', SILICONFLOW_API_KEY='sk-test')
+class DemoImageTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        _demo_image_urls.clear()
+        self.addCleanup(_demo_image_urls.clear)
+        self.service = deepseek_service.DeepSeekService()
+
+    def test_local_url_is_memoized(self):
+        cache.set(image_cache_key('p'), '/media/ai_images/p.png')
+        self.assertEqual(_cached_image(self.service, 'p'), '/media/ai_images/p.png')
+        cache.clear()
+        with mock.patch.object(self.service, '_request_image') as request_image:
+            self.assertEqual(_cached_image(self.service, 'p'), '/media/ai_images/p.png')
+        request_image.assert_not_called()
+
+    def test_failed_image_is_retried_next_time(self):
+        with mock.patch.object(self.service, '_request_image', return_value=None):
+            self.assertEqual(_cached_image(self.service, 'p'), IMAGE_ERROR_URL)
+        self.assertNotIn('p', _demo_image_urls)
+        self.assertIsNone(cache.get(image_cache_key('p')))
+        with mock.patch.object(self.service, '_request_image', return_value='https://cdn.example.com/p.png') as request_image:
+            self.assertEqual(_cached_image(self.service, 'p'), 'https://cdn.example.com/p.png')
+        request_image.assert_called_once()
+
+
+@override_settings(DEEPSEEK_API_KEY='sk-test', OPENROUTER_API_KEY='sk-test')
+class AnalyzeUserInputTests(TestCase):
+    BODY = '```json\n{"intent": "has_idea", "feedback": "不错", "visual_prompt": "a dark room",}\n```'
+
+    def setUp(self):
+        cache.clear()
+
+    def _analyze(self, service, finish_reason):
+        response = SimpleNamespace(choices=[SimpleNamespace(
+            message=SimpleNamespace(content=self.BODY), finish_reason=finish_reason
+        )])
+        with mock.patch.object(service.client.chat.completions, 'create', return_value=response) as create:
+            result = service.analyze_user_input('q', 'u', 'ctx')
+        self.assertNotIn('stream', create.call_args.kwargs)
+        return result
+
+    def test_complete_output_parsed_once(self):
+        for service in (deepseek_service.DeepSeekService(), OpenRouterService()):
+            with self.subTest(service=type(service).__name__):
+                self.assertEqual(self._analyze(service, 'stop'), {
+                    'intent': 'has_idea', 'feedback': '不错', 'visual_prompt': 'a dark room'
+                })
+
+    def test_truncated_output_is_unknown_and_not_cached(self):
+        service = deepseek_service.DeepSeekService()
+        self.assertEqual(self._analyze(service, 'length')['intent'], 'unknown')
+
+        # 截断的输出没有进缓存，同样的请求会再调用一次模型
+        with mock.patch.object(service.client.chat.completions, 'create', side_effect=RuntimeError('boom')) as create:
+            self.assertEqual(service.analyze_user_input('q', 'u', 'ctx')['intent'], 'unknown')
+        create.assert_called_once()
+
+
+def run_now(func, *args):
+    # 测试里让后台任务在当前线程执行，和测试用例共用同一个事务
+    future = Future()
+    try:
+        future.set_result(func(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def sse_events(response):
+    return [orjson.loads(frame[len(b"data: "):]) for frame in b"".join(response.streaming_content).split(b"\n\n") if frame]
+
+
+class ChatTurnTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('student', password='pw')
+        self.conversation = Conversation.objects.create(user=self.user, topic='为什么会有石油', status='visual_loop')
+        Interaction.objects.create(conversation=self.conversation, type='question', text_content='为什么会有石油')
+
+    def _stale_conversation(self):
+        conversation = Conversation.objects.get(pk=self.conversation.pk)
+        _recent_interactions(conversation)
+        # 另一个请求在本轮读到最近交互之后先写入了一轮
+        Interaction.objects.create(conversation=self.conversation, type='probe_answer', text_content='不知道')
+        return conversation
+
+    def test_stale_turn_raises(self):
+        conversation = self._stale_conversation()
+
+        with self.assertRaises(ConcurrentTurnError):
+            _save_turn(Interaction(conversation=conversation, type='probe_answer', text_content='不知道'), status='review')
+
+        self.assertEqual(self.conversation.interactions.count(), 2)
+        self.assertEqual(Conversation.objects.get(pk=self.conversation.pk).status, 'visual_loop')
+
+    def test_fresh_turn_saved(self):
+        conversation = Conversation.objects.get(pk=self.conversation.pk)
+        _recent_interactions(conversation)
+
+        _save_turn(
+            Interaction(conversation=conversation, type='probe_answer', text_content='地下的压力'),
+            Interaction(conversation=conversation, type='ai_feedback', text_content='很好'),
+            status='review'
+        )
+
+        self.assertEqual(self.conversation.interactions.count(), 3)
+        self.assertEqual(Conversation.objects.get(pk=self.conversation.pk).status, 'review')
+
+    def test_held_lock_returns_409(self):
+        calls = []
+        cache.add(f'chat-lock:{self.conversation.pk}', 1)
+
+        response = run_locked(self.conversation.pk, lambda: calls.append(1) or HttpResponse())
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(calls, [])
+
+    def test_concurrent_turn_returns_409_and_releases_lock(self):
+        def handler():
+            raise ConcurrentTurnError()
+
+        self.assertEqual(run_locked(self.conversation.pk, handler).status_code, 409)
+        self.assertEqual(run_locked(self.conversation.pk, HttpResponse).status_code, 200)
+
+    def test_stale_streamed_turn_is_reported_as_discarded(self):
+        conversation = self._stale_conversation()
+        user_interaction = Interaction(conversation=conversation, type='user_interpretation', text_content='是压力')
+
+        with mock.patch('core.views_helper.run_image_task', run_now), \
+                mock.patch('core.views_helper.enqueue_image_persist') as enqueue:
+            response = run_locked(conversation.pk, _image_reply, conversation, user_interaction, '看看这张图', 'p',
+                                  lambda prompt: 'https://cdn.example.com/p.png', True)
+            events = sse_events(response)
+
+        self.assertEqual(events, [
+            {'status': 'success', 'answer': '看看这张图'},
+            {'status': 'error', 'message': _DISCARDED_MESSAGE},
+        ])
+        self.assertFalse(self.conversation.interactions.filter(type='ai_image').exists())
+        enqueue.assert_not_called()
+        # 流结束后锁已释放
+        self.assertTrue(cache.add(f'chat-lock:{conversation.pk}', 1))
+
+
+class PersistImageTests(TestCase):
+    URL = 'https://cdn.example.com/a.png'
+
+    def setUp(self):
+        cache.clear()
+        conversation = Conversation.objects.create(user=User.objects.create_user('student'), topic='q')
+        self.interaction = Interaction.objects.create(conversation=conversation, type='ai_image', image_url=self.URL)
+
+    def _persist(self, local_url):
+        # 后台线程用完会关闭自己的连接；测试在同一个连接上运行，不能关
+        with mock.patch('core.tasks.save_image_from_url', return_value=local_url), mock.patch('core.tasks.connection'):
+            persist_interaction_image(self.interaction.pk, self.URL, 'p')
+        self.interaction.refresh_from_db()
+
+    def test_rewrites_url_to_local_copy(self):
+        self._persist('/media/ai_images/a.png')
+        self.assertEqual(self.interaction.image_url, '/media/ai_images/a.png')
+
+    def test_failed_download_keeps_original_url(self):
+        self._persist(None)
+        self.assertEqual(self.interaction.image_url, self.URL)
+
+    def test_row_changed_meanwhile_is_left_alone(self):
+        Interaction.objects.filter(pk=self.interaction.pk).update(image_url='/media/ai_images/b.png')
+        self._persist('/media/ai_images/a.png')
+        self.assertEqual(self.interaction.image_url, '/media/ai_images/b.png')
+
+    def test_enqueued_after_commit(self):
+        with mock.patch('core.tasks._EXECUTOR') as executor, self.captureOnCommitCallbacks(execute=True) as callbacks:
+            enqueue_image_persist(self.interaction.pk, self.URL, 'p')
+            executor.submit.assert_not_called()
+        self.assertEqual(len(callbacks), 1)
+        executor.submit.assert_called_once_with(persist_interaction_image, self.interaction.pk, self.URL, 'p')
+
+
+class PartialJSONParserTests(TestCase):
+    def test_skips_code_fence(self):
+        text = '```json\n{"intent": "has_idea", "feedback": "不错"}\n```'
+        self.assertEqual(parse_json(text), {'intent': 'has_idea', 'feedback': '不错'})
+
+    def test_trailing_comma_and_python_literals(self):
+        text = '{"intent": "explaining_image", "evaluation": "pass", "data": {"blanks": [1, 2,], "ok": True,},}'
+        self.assertEqual(parse_json(text), {
+            'intent': 'explaining_image',
+            'evaluation': 'pass',
+            'data': {'blanks': [1, 2], 'ok': True},
+        })
+
+    def test_fields_parsed_across_chunks(self):
+        parser = PartialJSONParser()
+        for chunk in ('{"inte', 'nt": "no', '_idea", "feed', 'back": "想一想"}'):
+            parser.feed(chunk)
+        self.assertTrue(parser.done)
+        self.assertEqual(parser.fields, {'intent': 'no_idea', 'feedback': '想一想'})
+
+    def test_truncated_value_only_salvaged_by_finish(self):
+        parser = PartialJSONParser()
+        parser.feed('{"intent": "has_idea", "data": {"blanks": ["a", "b')
+        # 没闭合的字段在 finish 之前不会出现在结果里
+        self.assertEqual(parser.fields, {'intent': 'has_idea'})
+        self.assertEqual(parser.finish(), {'intent': 'has_idea', 'data': {'blanks': ['a', 'b']}})
+
+    def test_no_object_returns_none(self):
+        self.assertIsNone(parse_json('Error: timeout'))
+        self.assertIsNone(parse_json(None))
+
+
+class ClassDetailTests(TestCase):
+    def setUp(self):
+        self.teacher = User.objects.create_user('teacher', password='pw')
+        self.teacher.profile.role = 'teacher'
+        self.teacher.profile.save()
+        self.classroom = Classroom.objects.create(teacher=self.teacher, name='物理')
+        self.client.force_login(self.teacher)
+
+    def test_counts_linked_and_unlinked_students(self):
+        linked = User.objects.create_user('linked')
+        unlinked = User.objects.create_user('unlinked')
+        self.classroom.students.add(linked, unlinked)
+        other_class = Classroom.objects.create(teacher=self.teacher, name='化学')
+        for topic in ('光', '电'):
+            Conversation.objects.create(user=linked, classroom=self.classroom, topic=topic)
+        Conversation.objects.create(user=linked, classroom=other_class, topic='酸碱')
+        for topic in ('力', '热', '声'):
+            Conversation.objects.create(user=unlinked, topic=topic)
+
+        response = self.client.get(reverse('class_detail', args=[self.classroom.pk]))
+
+        self.assertEqual(response.status_code, 200)
+        stats = {row['student'].username: row for row in response.context['student_stats']}
+        # 有对话关联到本班的学生只统计本班对话；还没有关联的学生退回统计全部对话
+        self.assertEqual(stats['linked']['conv_count'], 2)
+        self.assertEqual(sorted(stats['linked']['topics']), sorted(['光', '电']))
+        self.assertEqual(stats['unlinked']['conv_count'], 3)
+        self.assertEqual(sorted(stats['unlinked']['topics']), sorted(['力', '热', '声']))
+
+    def test_other_teachers_class_not_found(self):
+        other = User.objects.create_user('other_teacher')
+        classroom = Classroom.objects.create(teacher=other, name='数学')
+
+        response = self.client.get(reverse('class_detail', args=[classroom.pk]))
+
+        self.assertEqual(response.status_code, 404)
+
+
+class NewChatTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('student', password='pw')
+        self.client.force_login(self.user)
+
+    def _conversation(self, interaction_count, status='initial_probe'):
+        conversation = Conversation.objects.create(user=self.user, status=status)
+        for i in range(interaction_count):
+            Interaction.objects.create(conversation=conversation, type='ai_feedback', text_content=str(i))
+        return conversation
+
+    def test_reuses_conversation_with_only_the_greeting(self):
+        self._conversation(2)
+        empty = self._conversation(1)
+
+        response = self.client.get(reverse('chat_new'))
+
+        self.assertEqual(response.context['conversation'].pk, empty.pk)
+        self.assertEqual(Conversation.objects.count(), 2)
+
+    def test_creates_conversation_when_none_is_empty(self):
+        self._conversation(2)
+        self._conversation(1, status='visual_loop')
+
+        response = self.client.get(reverse('chat_new'))
+
+        self.assertEqual(Conversation.objects.count(), 3)
+        new = response.context['conversation']
+        self.assertEqual(new.status, 'initial_probe')
+        self.assertEqual(new.interactions.count(), 1)
+
+
+class ChallengeMigrationTests(TestCase):
+    def test_moves_challenge_block_into_metadata(self):
+        migration = importlib.import_module('core.migrations.0006_interaction_metadata')
+        conversation = Conversation.objects.create(user=User.objects.create_user('student'), topic='q')
+        legacy = Interaction.objects.create(
+            conversation=conversation, type='ai_feedback',
+            text_content='填一填 <CHALLENGE>{"type": "fill_in_the_blank", "data": {"answer": "压力"}}</CHALLENGE>'
+        )
+        broken = Interaction.objects.create(
+            conversation=conversation, type='ai_feedback', text_content='<CHALLENGE>not json</CHALLENGE>'
+        )
+
+        migration.move_challenges_to_metadata(apps, connection.schema_editor())
+
+        legacy.refresh_from_db()
+        self.assertEqual(legacy.text_content, '填一填')
+        self.assertEqual(legacy.metadata, {'challenge': {'type': 'fill_in_the_blank', 'data': {'answer': '压力'}}})
+        broken.refresh_from_db()
+        self.assertEqual(broken.text_content, '<CHALLENGE>not json</CHALLENGE>')
+        self.assertIsNone(broken.metadata)
+
+
+class RelativityDemoTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        _demo_image_urls.clear()
+        self.addCleanup(_demo_image_urls.clear)
+        self.conversation = Conversation.objects.create(user=User.objects.create_user('student'))
+        self.service = mock.Mock()
+        self.service.generate_image.side_effect = lambda prompt: f'https://cdn.example.com/{len(prompt)}.png'
+        patcher = mock.patch('core.views_helper.get_deepseek_service', return_value=self.service)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _send(self, user_input):
+        # 和 api_send_message 一样：每条消息重新查对话，只取状态机的几列并预取最近的交互
+        conversation = Conversation.objects.only(*CHAT_CONVERSATION_FIELDS).prefetch_related(
+            recent_interactions_prefetch()
+        ).get(pk=self.conversation.pk)
+        with mock.patch('core.views_helper.enqueue_image_persist'):
+            return orjson.loads(_handle_chat_response(conversation, user_input).content)
+
+    def _ai_reply_count(self):
+        return self.conversation.interactions.filter(type__in=['ai_feedback', 'ai_image']).count()
+
+    def test_demo_step_follows_ai_replies(self):
+        self._send('广义相对论是什么？')
+        for user_input in ('会一直走直线', '网格凹下去了', '顺着弯路走', '明白了', '时空'):
+            conversation = Conversation.objects.get(pk=self.conversation.pk)
+            self.assertEqual(conversation.demo_step, self._ai_reply_count())
+            self._send(user_input)
+
+        conversation = Conversation.objects.get(pk=self.conversation.pk)
+        self.assertEqual(conversation.demo_step, self._ai_reply_count())
+        self.assertEqual(conversation.demo_step, 6)
+        self.assertTrue(conversation.is_completed)
+
+    def test_script_steps_in_order(self):
+        self._send('广义相对论是什么？')
+        for entry in RELATIVITY_SCRIPT:
+            reply = self._send('我看到了')
+            self.assertEqual(reply['answer'], entry['text'])
+            self.assertEqual(self.conversation.interactions.last().image_prompt, entry['prompt'])
+
+        reply = self._send('明白了')
+        self.assertEqual(reply['challenge'], RELATIVITY_CHALLENGE)
+        reply = self._send('时空')
+        self.assertEqual(reply['final_review'], RELATIVITY_FINAL_REVIEW)
+        self.assertEqual(
+            [call.args[0] for call in self.service.generate_image.call_args_list],
+            [entry['prompt'] for entry in RELATIVITY_SCRIPT]
+        )
+
+
+class StreamedReplyTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        _demo_image_urls.clear()
+        self.addCleanup(_demo_image_urls.clear)
+        self.user = User.objects.create_user('student', password='pw')
+        self.conversation = Conversation.objects.create(user=self.user, topic='q')
+
+    def test_text_then_image_url(self):
+        user_interaction = Interaction(conversation=self.conversation, type='probe_answer', text_content='不知道')
+
+        with mock.patch('core.views_helper.run_image_task', run_now), \
+                mock.patch('core.views_helper.enqueue_image_persist') as enqueue:
+            response = _image_reply(
+                self.conversation, user_interaction, '看看这张图', lambda: 'a dark room',
+                lambda prompt: 'https://cdn.example.com/p.png', True, status='visual_loop'
+            )
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            events = sse_events(response)
+
+        self.assertEqual(events, [
+            {'status': 'success', 'answer': '看看这张图'},
+            {'image_url': 'https://cdn.example.com/p.png'},
+        ])
+        image = self.conversation.interactions.get(type='ai_image')
+        self.assertEqual((image.image_url, image.image_prompt, image.text_content),
+                         ('https://cdn.example.com/p.png', 'a dark room', '看看这张图'))
+        self.assertEqual(Conversation.objects.get(pk=self.conversation.pk).status, 'visual_loop')
+        enqueue.assert_called_once_with(image.pk, 'https://cdn.example.com/p.png', 'a dark room')
+
+    def test_send_message_streams_when_accepted(self):
+        conversation = Conversation.objects.create(
+            user=self.user, topic='[DEMO] Relativity', status='visual_loop', demo_step=1
+        )
+        service = mock.Mock()
+        service.generate_image.return_value = 'https://cdn.example.com/step1.png'
+        self.client.force_login(self.user)
+
+        with mock.patch('core.views_helper.get_deepseek_service', return_value=service), \
+                mock.patch('core.views_helper.run_image_task', run_now), \
+                mock.patch('core.views_helper.enqueue_image_persist'):
+            response = self.client.post(
+                reverse('api_send_message'),
+                orjson.dumps({'conversation_id': conversation.pk, 'query': '会一直走直线'}),
+                content_type='application/json', HTTP_ACCEPT='text/event-stream'
+            )
+            events = sse_events(response)
+
+        self.assertEqual(len(events), 2)
+        self.assertEqual(events[0]['status'], 'success')
+        self.assertIn('answer', events[0])
+        self.assertEqual(events[1], {'image_url': 'https://cdn.example.com/step1.png'})
+
+
+class ChatJobTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        _demo_image_urls.clear()
+        self.addCleanup(_demo_image_urls.clear)
+        self.user = User.objects.create_user('student', password='pw')
+        self.client.force_login(self.user)
+
+    def _poll(self, task_id):
+        return self.client.get(reverse('api_chat_job', args=[task_id]))
+
+    @override_settings(CHAT_ASYNC_JOBS=True)
+    def test_respond_async_is_polled_until_done(self):
+        conversation = Conversation.objects.create(
+            user=self.user, topic='[DEMO] Relativity', status='visual_loop', demo_step=1
+        )
+        service = mock.Mock()
+        service.generate_image.return_value = 'https://cdn.example.com/step1.png'
+
+        with mock.patch('core.tasks._CHAT_EXECUTOR') as executor, \
+                mock.patch('core.tasks.connection'), \
+                mock.patch('core.views_helper.get_deepseek_service', return_value=service), \
+                mock.patch('core.views_helper.run_image_task', run_now), \
+                mock.patch('core.views_helper.enqueue_image_persist'):
+            response = self.client.post(
+                reverse('api_send_message'),
+                orjson.dumps({'conversation_id': conversation.pk, 'query': '会一直走直线'}),
+                content_type='application/json', HTTP_PREFER='respond-async'
+            )
+            self.assertEqual(response.status_code, 202)
+            task_id = orjson.loads(response.content)['task_id']
+            self.assertEqual(orjson.loads(self._poll(task_id).content), {'status': 'pending', 'done': False})
+
+            # 执行排队的任务
+            func, *args = executor.submit.call_args.args
+            func(*args)
+
+        job = orjson.loads(self._poll(task_id).content)
+        self.assertEqual(job['status'], 'success')
+        self.assertEqual(job['answer'], RELATIVITY_SCRIPT[0]['text'])
+        self.assertEqual(job['image_url'], 'https://cdn.example.com/step1.png')
+        self.assertTrue(job['done'])
+        self.assertNotIn('user_id', job)
+
+    def test_job_is_scoped_to_its_user(self):
+        with mock.patch('core.tasks._CHAT_EXECUTOR'):
+            task_id = submit_chat_job(self.user.id, HttpResponse)
+        self.assertEqual(self._poll(task_id).status_code, 200)
+
+        self.client.force_login(User.objects.create_user('other', password='pw'))
+        self.assertEqual(self._poll(task_id).status_code, 404)
+        self.assertEqual(self._poll('missing').status_code, 404)
+
+
+class RollbackTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('student', password='pw')
+        self.client.force_login(self.user)
+
+    def test_rollback_recounts_demo_step(self):
+        conversation = Conversation.objects.create(
+            user=self.user, topic='[DEMO] 引力是什么', status='review', is_completed=True, demo_step=3
+        )
+        types = ['question', 'ai_feedback', 'probe_answer', 'ai_image', 'user_interpretation', 'ai_feedback']
+        interactions = [Interaction.objects.create(conversation=conversation, type=t, text_content=t) for t in types]
+
+        response = self.client.post(
+            reverse('api_rollback_conversation'),
+            orjson.dumps({'conversation_id': conversation.pk, 'interaction_id': interactions[3].pk}),
+            content_type='application/json'
+        )
+
+        self.assertEqual(response.status_code, 200)
+        conversation.refresh_from_db()
+        self.assertEqual(conversation.demo_step, 2)
+        self.assertEqual(conversation.status, 'visual_loop')
+        self.assertFalse(conversation.is_completed)
+        self.assertEqual(conversation.interactions.count(), 4)
@@ -20,5 +20,6 @@ urlpatterns = [
     path('chat/<int:conversation_id>/delete/', views.delete_conversation, name='delete_conversation'),
     path('api/send_message/', views.api_send_message, name='api_send_message'),
     path('api/retry/', views.api_retry_last_message, name='api_retry_last_message'),
+    path('api/chat_job/<str:task_id>/', views.api_chat_job, name='api_chat_job'),
     path('api/rollback/', views.api_rollback_conversation, name='api_rollback_conversation'),
 ]
@@ -1,54 +1,133 @@
+import hashlib
+import importlib.util
+import logging
 import os
+import orjson
 import requests
+import tempfile
 import uuid
 from django.conf import settings
 from django.core.files.base import ContentFile
+from django.http import HttpResponse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# 外部 HTTP 请求的超时时间: (连接超时, 读取超时)
+HTTP_TIMEOUT = (10, 60)
+
+def json_response(payload, status=200):
+    """
+    用 orjson 直接序列化成 UTF-8 bytes 返回，代替 JsonResponse 的 DjangoJSONEncoder
+    """
+    return HttpResponse(orjson.dumps(payload), content_type='application/json', status=status)
+
+def create_http_session(pool_connections=20, pool_maxsize=100):
+    """
+    创建带连接池的 requests.Session，复用 TCP + TLS 连接，避免每次请求重新握手
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        max_retries=Retry(total=2, backoff_factor=0.3)
+    )
+    session.mount('https://', adapter)
+    return session
+
+# 安装了 h2 时对外请求走 HTTP/2：同一个 TLS 连接上多路复用并发请求
+HTTP2_AVAILABLE = importlib.util.find_spec('h2') is not None
+
+def create_openai_http_client():
+    """
+    给 OpenAI SDK 用的 httpx 客户端，保持 keep-alive 连接池
+    学生两轮对话之间通常隔几十秒，空闲连接保留 60 秒，下一轮不用重新握手
+    """
+    # 在函数里导入：openai 和 httpx 只在创建模型服务时才需要，普通页面的进程不用加载它
+    import httpx
+    from openai import DefaultHttpxClient
+    return DefaultHttpxClient(
+        http2=HTTP2_AVAILABLE,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=100, keepalive_expiry=60)
+    )
+
+# 下载图片共用的会话
+_SESSION = create_http_session()
+
+_AI_IMAGES_DIR = os.path.join(settings.MEDIA_ROOT, 'ai_images')
+_USER_UPLOADS_DIR = os.path.join(settings.MEDIA_ROOT, 'user_uploads')
+
+# 下载时每次读取的块大小
+_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# 已确认存在的目录，避免每次保存都 makedirs 一遍
+_dirs_ensured = set()
+
+def _ensure_dir(path):
+    if path not in _dirs_ensured:
+        os.makedirs(path, exist_ok=True)
+        _dirs_ensured.add(path)
+    return path
 
 def save_image_from_url(image_url):
     """
     下载图片并保存到 media/ai_images/ 目录
+    文件名取图片内容的 sha256，相同的图片只存一份
     返回相对路径 (e.g. /media/ai_images/xxx.png)
     """
+    tmp_path = None
     try:
-        response = requests.get(image_url, timeout=10)
-        response.raise_for_status()
-        
-        # 确保目录存在
-        save_dir = os.path.join(settings.MEDIA_ROOT, 'ai_images')
-        os.makedirs(save_dir, exist_ok=True)
-        
-        # 生成唯一文件名
-        filename = f"{uuid.uuid4()}.png"
+        # stream=True: 边下载边写盘，不把整张图片读进内存
+        with _SESSION.get(image_url, timeout=HTTP_TIMEOUT, stream=True) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+
+            # 确保目录存在
+            save_dir = _ensure_dir(_AI_IMAGES_DIR)
+
+            # 先写临时文件，边写边算哈希；写完再原子替换，避免并发请求读到写了一半的图片
+            digest = hashlib.sha256()
+            with tempfile.NamedTemporaryFile(dir=save_dir, suffix='.part', delete=False) as f:
+                tmp_path = f.name
+                for chunk in iter(lambda: response.raw.read(_DOWNLOAD_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    f.write(chunk)
+
+        filename = f"{digest.hexdigest()}.png"
         file_path = os.path.join(save_dir, filename)
-        
-        with open(file_path, 'wb') as f:
-            f.write(response.content)
-            
+        # 已经存过同样的图片就直接复用，临时文件在 finally 里删除
+        if not os.path.exists(file_path):
+            os.replace(tmp_path, file_path)
+            tmp_path = None
+
         return f"{settings.MEDIA_URL}ai_images/{filename}"
     except Exception as e:
-        print(f"Error saving image: {e}")
+        logger.error("Error saving image: %s", e)
         return None
+    finally:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
-def save_uploaded_file(uploaded_file):
+def save_uploaded_bytes(data, name):
     """
-    保存上传的文件到 media/user_uploads/ 目录
+    保存上传的图片内容到 media/user_uploads/ 目录
+    调用方已经把上传文件读进内存（同一份 bytes 还要交给视觉模型），这里一次写盘，不再包一层文件对象分块复制
     """
     try:
-        save_dir = os.path.join(settings.MEDIA_ROOT, 'user_uploads')
-        os.makedirs(save_dir, exist_ok=True)
+        save_dir = _ensure_dir(_USER_UPLOADS_DIR)
         
-        ext = os.path.splitext(uploaded_file.name)[1]
+        ext = os.path.splitext(name)[1]
         if not ext:
             ext = '.jpg' # Default
             
-        filename = f"{uuid.uuid4()}{ext}"
+        filename = f"{uuid.uuid4().hex}{ext}"
         file_path = os.path.join(save_dir, filename)
         
         with open(file_path, 'wb') as f:
-            for chunk in uploaded_file.chunks():
-                f.write(chunk)
+            f.write(data)
                 
         return f"{settings.MEDIA_URL}user_uploads/{filename}", file_path
     except Exception as e:
-        print(f"Error saving uploaded file: {e}")
+        logger.error("Error saving uploaded file: %s", e)
         return None, None
\ No newline at end of file
@@ -1,25 +1,23 @@
+from django.conf import settings
 from django.shortcuts import render, get_object_or_404, redirect
-from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth import login
-from django.db import models
-from .models import Conversation, Interaction, ThinkingReview, UserProfile, Classroom
-from .services.deepseek_service import DeepSeekService
-import json
+from django.db import models, transaction
+from django.db.models import Exists, OuterRef, Prefetch, prefetch_related_objects
+from django.core.files.base import ContentFile
+from django.utils import timezone
+from .models import Conversation, Interaction, ThinkingReview, Classroom
+from .tasks import get_chat_job, submit_chat_job
+from .utils import json_response
+import orjson
 
 def index(request):
-    if request.user.is_authenticated:
-        # 使用 hasattr 避免处理 DoesNotExist 异常的复杂性
-        if hasattr(request.user, 'profile'):
-            profile = request.user.profile
-            if profile.role == 'teacher':
-                return redirect('teacher_dashboard')
-        else:
-            # Create default profile if missing
-            UserProfile.objects.create(user=request.user, role='student')
-    
+    # profile 已随用户一起加载 (core.backends.ProfileModelBackend)，缺失的 profile 由 post_save 信号补上
+    if request.user.is_authenticated and request.user.profile.role == 'teacher':
+        return redirect('teacher_dashboard')
+
     # For students or anonymous
     return render(request, 'index.html')
 
@@ -32,13 +30,10 @@ def signup(request):
         role = request.POST.get('role', 'student')
         if form.is_valid():
             user = form.save()
-            # Update Profile
-            if hasattr(user, 'profile'):
-                user.profile.role = role
-                user.profile.save()
-            else:
-                UserProfile.objects.create(user=user, role=role)
-                
+            # post_save 信号已经创建了 profile，这里只更新角色
+            user.profile.role = role
+            user.profile.save(update_fields=['role'])
+
             login(request, user)
             return redirect('index')
     else:
@@ -51,7 +46,10 @@ def teacher_dashboard(request):
     if request.user.profile.role != 'teacher':
         return redirect('index')
     
-    classes = request.user.teaching_classes.all().order_by('-created_at')
+    # 只取卡片上展示的列；学生人数随列表一次聚合出来，不再每个班级单独 COUNT
+    classes = request.user.teaching_classes.only(
+        'id', 'teacher', 'name', 'code', 'description', 'created_at'
+    ).annotate(student_count=models.Count('students')).order_by('-created_at')
     
     return render(request, 'dashboard_teacher.html', {'classes': classes})
 
@@ -70,34 +68,49 @@ def class_detail(request, class_id):
         return redirect('index')
         
     classroom = get_object_or_404(Classroom, id=class_id, teacher=request.user)
-    students = classroom.students.all()
-    
+
     # Simple Stats
-    # Get all conversations from students in this class
-    # Since we didn't force link conversations to class yet in existing data, 
-    # we filter conversations by students.
-    # Ideally, we should filter by conversation.classroom once implemented fully.
-    # For now, let's get all conversations of these students.
-    
+    # 一次聚合查出每个学生在本班的对话数；每人最近 5 个对话用切片 prefetch 一次取回，
+    # 最近活跃时间和话题都从这 5 条里取，不再对每个学生分别 exists / count / first / 切片
+    # 模板只用到学生的用户名和对话的话题 / 更新时间，不加载密码哈希、context_summary 等列
+    students = list(classroom.students.only('id', 'username').prefetch_related(Prefetch(
+        'conversations',
+        queryset=Conversation.objects.filter(classroom=classroom).only(*_STAT_CONV_FIELDS).order_by('-updated_at')[:5],
+        to_attr='class_convs'
+    )))
+    stats = _conversation_stats(Conversation.objects.filter(classroom=classroom, user__in=students))
+
+    # Fallback: 还没有对话关联到本班的学生（旧数据），显示他们的全部对话
+    unlinked = [s for s in students if s.id not in stats]
+    if unlinked:
+        prefetch_related_objects(unlinked, Prefetch(
+            'conversations',
+            queryset=Conversation.objects.only(*_STAT_CONV_FIELDS).order_by('-updated_at')[:5],
+            to_attr='all_convs'
+        ))
+        stats.update(_conversation_stats(Conversation.objects.filter(user__in=unlinked)))
+
     student_stats = []
     for s in students:
-        convs = s.conversations.filter(classroom=classroom).order_by('-updated_at')
-        if not convs.exists():
-             # Fallback: check all convs if not explicitly linked (backward compatibility or loose mode)
-             # But for strict class management, we should only show linked ones.
-             # Let's show all for now but mark them.
-             convs = s.conversations.all().order_by('-updated_at')
-        
-        stat = {
+        recent_convs = getattr(s, 'all_convs', s.class_convs)
+        student_stats.append({
             'student': s,
-            'conv_count': convs.count(),
-            'last_active': convs.first().updated_at if convs.exists() else None,
-            'topics': [c.topic for c in convs[:5]]
-        }
-        student_stats.append(stat)
-        
+            'conv_count': stats.get(s.id, 0),
+            'last_active': recent_convs[0].updated_at if recent_convs else None,
+            'topics': [c.topic for c in recent_convs]
+        })
+
     return render(request, 'class_detail.html', {'classroom': classroom, 'student_stats': student_stats})
 
+_STAT_CONV_FIELDS = ('id', 'user', 'topic', 'updated_at')
+
+def _conversation_stats(conversations):
+    """
+    按学生统计对话数，返回 {user_id: conv_count}
+    """
+    rows = conversations.values('user_id').annotate(conv_count=models.Count('id')).order_by()
+    return {row['user_id']: row['conv_count'] for row in rows}
+
 @login_required
 def join_class(request):
     if request.method == 'POST':
@@ -122,10 +135,14 @@ def chat_view(request, conversation_id=None):
         # For MVP, if user is enrolled in classes, auto-link to the first one (or recently joined).
         
         # 查找是否存在未开始的空对话
+        # "空对话" = 最多只有一条开场白；用 EXISTS 判断是否存在第二条，不再 COUNT + GROUP BY
+        has_second_interaction = Exists(
+            Interaction.objects.filter(conversation=OuterRef('pk'))[1:]
+        )
         existing_empty_conv = Conversation.objects.filter(
-            user=request.user, 
+            user=request.user,
             status='initial_probe'
-        ).annotate(count=models.Count('interactions')).filter(count__lte=1).first()
+        ).filter(~has_second_interaction).first()
         
         if existing_empty_conv:
             conversation = existing_empty_conv
@@ -135,33 +152,47 @@ def chat_view(request, conversation_id=None):
             if request.user.profile.role == 'student':
                 classroom = request.user.enrolled_classes.first()
             
-            conversation = Conversation.objects.create(user=request.user, classroom=classroom)
-            
-            Interaction.objects.create(
-                conversation=conversation,
-                type='ai_feedback',
-                text_content="你好。我是你的辅助思考助手。请告诉我，你遇到了哪道题？或者想弄懂什么概念？"
-            )
+            with transaction.atomic():
+                conversation = Conversation.objects.create(user=request.user, classroom=classroom)
+                
+                Interaction.objects.create(
+                    conversation=conversation,
+                    type='ai_feedback',
+                    text_content="你好。我是你的辅助思考助手。请告诉我，你遇到了哪道题？或者想弄懂什么概念？"
+                )
     
-    interactions = conversation.interactions.all().order_by('created_at')
+    # 模板只用到这几个字段，不加载 image_prompt 等大文本
+    # 按 id 排序：同一轮的用户消息和 AI 回复由一次 bulk_create 写入，created_at 可能相同，id 才是确定的写入顺序
+    # (通过关联管理器查询时 Django 会给每行回填外键，外键列必须在 only 里，否则每行多一次查询)
+    interactions = list(conversation.interactions.only(
+        'id', 'conversation', 'type', 'text_content', 'image_url', 'metadata'
+    ).order_by('id'))
+    # 挑战题通过 json_script 交给前端，按 interaction id 索引
+    challenges = {i.id: i.metadata['challenge'] for i in interactions if i.metadata and 'challenge' in i.metadata}
     
-    from django.conf import settings
     return render(request, 'book.html', {
         'conversation': conversation,
         'interactions': interactions,
-        'desmos_api_key': settings.DESMOS_API_KEY
+        'challenges': challenges,
+        # 侧边栏列表只显示话题和创建时间
+        'sidebar_conversations': request.user.conversations.only('id', 'user', 'topic', 'created_at'),
+        'desmos_api_key': settings.DESMOS_API_KEY,
+        'async_chat': settings.CHAT_ASYNC_JOBS
     })
 
 @login_required
 @csrf_exempt
 def delete_conversation(request, conversation_id):
     if request.method == 'POST':
-        conversation = get_object_or_404(Conversation, id=conversation_id, user=request.user)
+        conversation = get_object_or_404(Conversation.objects.only('id'), id=conversation_id, user=request.user)
         conversation.delete()
-        return JsonResponse({'status': 'success'})
-    return JsonResponse({'status': 'error', 'message': 'Invalid method'}, status=405)
+        return json_response({'status': 'success'})
+    return json_response({'status': 'error', 'message': 'Invalid method'}, status=405)
 
-from .views_helper import _handle_chat_response, api_retry_last_message
+from .views_helper import (
+    CHAT_CONVERSATION_FIELDS, _handle_chat_response, api_retry_last_message, demo_step_count,
+    recent_interactions_prefetch, run_locked
+)
 
 @login_required
 @csrf_exempt
@@ -175,45 +206,86 @@ def api_send_message(request):
         else:
             # Fallback for JSON (e.g. from existing logic or tests)
             try:
-                data = json.loads(request.body)
+                data = orjson.loads(request.body)
                 conversation_id = data.get('conversation_id')
                 user_input = data.get('query')
                 image_file = None
-            except json.JSONDecodeError:
-                return JsonResponse({'status': 'error', 'message': 'Invalid JSON'}, status=400)
+            except orjson.JSONDecodeError:
+                return json_response({'status': 'error', 'message': 'Invalid JSON'}, status=400)
         
-        conversation = get_object_or_404(Conversation, id=conversation_id, user=request.user)
+        # 最近几条交互随对话一起取回，处理消息时不再单独 last() / 查上下文；对话本身只取状态机用到的几列
+        conversation = get_object_or_404(
+            Conversation.objects.only(*CHAT_CONVERSATION_FIELDS).prefetch_related(recent_interactions_prefetch()),
+            id=conversation_id, user=request.user
+        )
         
-        return _handle_chat_response(conversation, user_input, image_file)
+        # Prefer: respond-async 时交给后台队列处理，立即返回 task_id，前端轮询 api_chat_job（需要共享缓存）
+        if settings.CHAT_ASYNC_JOBS and 'respond-async' in request.headers.get('Prefer', ''):
+            if image_file:
+                # 请求结束后上传的临时文件会被清理，先读进内存再交给后台
+                image_file = ContentFile(image_file.read(), name=image_file.name)
+            task_id = submit_chat_job(
+                request.user.id, run_locked, conversation.id,
+                _handle_chat_response, conversation, user_input, image_file, True
+            )
+            return json_response({'status': 'pending', 'task_id': task_id}, status=202)
+        
+        # 前端声明 Accept: text/event-stream 时，需要生图的回合改用 SSE 分两次推送
+        stream = 'text/event-stream' in request.headers.get('Accept', '')
+        return run_locked(conversation.id, _handle_chat_response, conversation, user_input, image_file, stream)
             
-    return JsonResponse({'status': 'error', 'message': 'Invalid method'}, status=405)
+    return json_response({'status': 'error', 'message': 'Invalid method'}, status=405)
+
+@login_required
+def api_chat_job(request, task_id):
+    """
+    轮询后台处理的消息：status 为 pending 表示还没有回复；done 为 true 表示已全部完成（含图片）
+    """
+    job = get_chat_job(task_id, request.user.id)
+    if job is None:
+        return json_response({'status': 'error', 'message': 'Task not found'}, status=404)
+    return json_response(job)
 
 @login_required
 @csrf_exempt
 def api_rollback_conversation(request):
     if request.method == 'POST':
         try:
-            data = json.loads(request.body)
+            data = orjson.loads(request.body)
             conversation_id = data.get('conversation_id')
             interaction_id = data.get('interaction_id')
             
-            conversation = get_object_or_404(Conversation, id=conversation_id, user=request.user)
-            target_interaction = get_object_or_404(Interaction, id=interaction_id, conversation=conversation)
+            # 一次 JOIN 同时校验对话归属并取回目标交互
+            target_interaction = get_object_or_404(
+                Interaction.objects.select_related('conversation').only(
+                    'id', 'conversation', 'conversation__topic', 'conversation__status', 'conversation__is_completed'
+                ),
+                id=interaction_id, conversation_id=conversation_id, conversation__user=request.user
+            )
+            conversation = target_interaction.conversation
             
             # Delete all interactions strictly AFTER the target
             # Note: We rely on created_at or id order. ID is safer for insertion order usually.
-            Interaction.objects.filter(
-                conversation=conversation,
-                id__gt=target_interaction.id
-            ).delete()
-            
-            # Reset status if needed
-            if conversation.status == 'review' or conversation.is_completed:
-                conversation.status = 'visual_loop'
-                conversation.is_completed = False
-                conversation.save()
+            # Interaction 没有下级外键和删除信号，Django 直接发一条 DELETE，不会先逐行 SELECT
+            with transaction.atomic():
+                Interaction.objects.filter(
+                    conversation=conversation,
+                    id__gt=target_interaction.id
+                ).delete()
+                
+                updates = {}
+                # Reset status if needed
+                if conversation.status == 'review' or conversation.is_completed:
+                    updates.update(status='visual_loop', is_completed=False)
+                # 演示脚本的步数跟着被删掉的 AI 回复一起回退，在同一条 UPDATE 里用子查询重新计数
+                if conversation.topic.startswith("[DEMO]"):
+                    updates['demo_step'] = demo_step_count()
+                if updates:
+                    Conversation.objects.filter(pk=conversation.pk).update(updated_at=timezone.now(), **updates)
                 
-            return JsonResponse({'status': 'success'})
+            return json_response({'status': 'success'})
+        except orjson.JSONDecodeError:
+            return json_response({'status': 'error', 'message': 'Invalid JSON'}, status=400)
         except Exception as e:
-            return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
-    return JsonResponse({'status': 'error', 'message': 'Invalid method'}, status=405)
+            return json_response({'status': 'error', 'message': str(e)}, status=500)
+    return json_response({'status': 'error', 'message': 'Invalid method'}, status=405)
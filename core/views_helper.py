@@ -1,10 +1,21 @@
+from django.conf import settings
+from django.core.cache import cache
 from django.shortcuts import get_object_or_404
-from django.http import JsonResponse
+from django.http import StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.decorators import login_required
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Prefetch, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 from .models import Conversation, Interaction, ThinkingReview
-from .services.deepseek_service import DeepSeekService
-import json
+import functools
+import logging
+import orjson
+import re
+import unicodedata
+
+logger = logging.getLogger(__name__)
 
 @login_required
 @csrf_exempt
@@ -13,79 +24,303 @@ def api_retry_last_message(request):
     重试/补全最后一条未回复的用户消息
     """
     if request.method == 'POST':
-        data = json.loads(request.body)
+        try:
+            data = orjson.loads(request.body)
+        except orjson.JSONDecodeError:
+            return json_response({'status': 'error', 'message': 'Invalid JSON'}, status=400)
         conversation_id = data.get('conversation_id')
-        conversation = get_object_or_404(Conversation, id=conversation_id, user=request.user)
-        
-        last_interaction = conversation.interactions.last()
+        conversation = get_object_or_404(
+            Conversation.objects.only(*CHAT_CONVERSATION_FIELDS).prefetch_related(recent_interactions_prefetch()),
+            id=conversation_id, user=request.user
+        )
         
-        # 只有当最后一条消息是用户发出的，才需要重试
-        if last_interaction and last_interaction.type in ['question', 'probe_answer', 'user_interpretation']:
-            # 伪造一个 request.body 再次调用 api_send_message
-            # 但我们需要稍微修改 api_send_message 逻辑，避免它重复创建用户消息
-            # 简单起见，这里直接复用 api_send_message 的核心逻辑，或者重构
-            
-            # 由于 api_send_message 会先创建用户消息，直接调用会导致重复
-            # 所以我们必须重构逻辑。
-            # 方案：调用一个新的内部函数 _process_chat_logic，它接受 user_input 但不创建 Interaction
-            
-            user_input = last_interaction.text_content
-            
-            # 删除最后这条用户消息，因为它会在 _process_chat_logic 中被重新创建
-            # 这是一个简单的 hack，避免大规模重构
-            last_interaction.delete()
-            
-            # 构造新的 request 对象传递给 api_send_message
-            # 或者更优雅地：将逻辑抽取出来。
-            # 为了快速修复，我们抽取逻辑到 _handle_chat_response
-            
-            return _handle_chat_response(conversation, user_input)
-            
-        return JsonResponse({'status': 'no_need_to_retry'})
-    return JsonResponse({'status': 'error'}, status=405)
+        if settings.CHAT_ASYNC_JOBS and 'respond-async' in request.headers.get('Prefer', ''):
+            task_id = submit_chat_job(request.user.id, run_locked, conversation.id, _retry_last_message, conversation)
+            return json_response({'status': 'pending', 'task_id': task_id}, status=202)
+        return run_locked(conversation.id, _retry_last_message, conversation)
+    return json_response({'status': 'error'}, status=405)
 
-from core.utils import save_uploaded_file
+def _retry_last_message(conversation):
+    # 最近几条交互只查一次：取出最后一条判断是否需要重试，删掉它之后剩下的直接留给 _handle_chat_response 拼上下文
+    recent = _recent_interactions(conversation)
+    last_interaction = recent[0] if recent else None
 
-def _handle_chat_response(conversation, user_input, image_file=None):
-    ai_service = DeepSeekService()
-    
-    # Check if image uploaded
-    uploaded_image_url = None
-    uploaded_image_path = None
-    
-    if image_file:
-        uploaded_image_url, uploaded_image_path = save_uploaded_file(image_file)
-    
+    # 只有当最后一条消息是用户发出的，才需要重试
+    if last_interaction and last_interaction.type in ['question', 'probe_answer', 'user_interpretation']:
+        # 伪造一个 request.body 再次调用 api_send_message
+        # 但我们需要稍微修改 api_send_message 逻辑，避免它重复创建用户消息
+        # 简单起见，这里直接复用 api_send_message 的核心逻辑，或者重构
+
+        # 由于 api_send_message 会先创建用户消息，直接调用会导致重复
+        # 所以我们必须重构逻辑。
+        # 方案：调用一个新的内部函数 _process_chat_logic，它接受 user_input 但不创建 Interaction
+
+        user_input = last_interaction.text_content
+
+        # 删除最后这条用户消息，因为它会在 _process_chat_logic 中被重新创建
+        # 这是一个简单的 hack，避免大规模重构
+        last_interaction.delete()
+        conversation.recent_ix = recent[1:]
+
+        # 构造新的 request 对象传递给 api_send_message
+        # 或者更优雅地：将逻辑抽取出来。
+        # 为了快速修复，我们抽取逻辑到 _handle_chat_response
+
+        return _handle_chat_response(conversation, user_input)
+
+    return json_response({'status': 'no_need_to_retry'})
+
+from core.utils import json_response, save_uploaded_bytes
+from core.tasks import enqueue_image_persist, run_image_task, submit_chat_job
+
+# 同一对话同一时间只处理一条消息：重复提交不会再调用一次模型、写入两份回复
+CONVERSATION_LOCK_TTL = 300
+
+_BUSY_MESSAGE = '上一条消息还在处理中，请稍候'
+# 流式回复已经推送了文字、写库时才发现另一个请求先完成了这一轮：本轮不保存，前端撤回这条回复
+_DISCARDED_MESSAGE = '另一条消息先完成了这一轮，本条回复没有保存，请刷新后再试'
+
+class ConcurrentTurnError(Exception):
+    """
+    写库时发现本轮开始之后对话里已经有了新的交互（锁过期或多进程下另一个请求先完成了同一轮）
+    """
+
+def run_locked(conversation_id, handler, *args):
+    """
+    持有对话锁执行 handler(*args) 并返回它的响应；对话正在处理上一条消息时直接返回 409
+    流式响应要等最后一个事件推送完（图片已写库）才释放锁
+    """
+    key = f'chat-lock:{conversation_id}'
+    if not cache.add(key, 1, CONVERSATION_LOCK_TTL):
+        return json_response({'status': 'error', 'message': _BUSY_MESSAGE}, status=409)
+    try:
+        response = handler(*args)
+    except ConcurrentTurnError:
+        cache.delete(key)
+        return json_response({'status': 'error', 'message': _BUSY_MESSAGE}, status=409)
+    except BaseException:
+        cache.delete(key)
+        raise
+    if response.streaming:
+        response.streaming_content = _release_after(response.streaming_content, key)
+    else:
+        cache.delete(key)
+    return response
+
+def _release_after(events, key):
+    try:
+        yield from events
+    finally:
+        cache.delete(key)
+
+# 处理一条消息最多用到最近 5 条交互（上一条的类型 + 拼上下文）
+RECENT_INTERACTIONS = 5
+_RECENT_FIELDS = ('id', 'conversation', 'type', 'text_content', 'image_prompt')
+# 处理消息只读写对话的这几列（状态机 + 演示步数），不加载 context_summary 等大文本
+CHAT_CONVERSATION_FIELDS = ('id', 'user', 'topic', 'status', 'is_completed', 'demo_step')
+
+def recent_interactions_prefetch():
+    """
+    api_send_message 查对话时一并取回最近几条交互（按 id 倒序，存到 conversation.recent_ix）
+    """
+    return Prefetch(
+        'interactions',
+        queryset=Interaction.objects.only(*_RECENT_FIELDS).order_by('-id')[:RECENT_INTERACTIONS],
+        to_attr='recent_ix'
+    )
+
+def demo_step_count():
+    """
+    演示步数 = 对话里 AI 回复的条数，作为子查询放进 UPDATE 里由数据库计算，不单独发 COUNT
+    """
+    ai_count = Interaction.objects.filter(
+        conversation=OuterRef('pk'), type__in=['ai_feedback', 'ai_image']
+    ).values('conversation').annotate(n=Count('id')).values('n')
+    return Coalesce(Subquery(ai_count), 0)
+
+def _recent_interactions(conversation):
+    """
+    最近几条交互，按 id 倒序；没有 prefetch 过（例如重试接口）时查一次库
+    """
+    recent = getattr(conversation, 'recent_ix', None)
+    if recent is None:
+        recent = list(conversation.interactions.only(*_RECENT_FIELDS).order_by('-id')[:RECENT_INTERACTIONS])
+        conversation.recent_ix = recent
+    return recent
+
+def _save_turn(*interactions, **conversation_updates):
+    """
+    把本轮的用户消息和 AI 回复（以及对话状态的变更）放在一个事务里写入：
+    一次 bulk_create + 至多一次 UPDATE，而不是逐条 INSERT 再整行 save()
+    模型调用等耗时操作都在此之前完成，事务里只有写库
+    写入前锁住对话行，确认本轮读到最近交互之后没有别的请求写入过，否则抛出 ConcurrentTurnError
+    (缓存锁的兜底；SQLite 不支持 select_for_update，但写事务本身是串行的)
+    (bulk_create 依赖数据库返回主键，SQLite 3.35+ / PostgreSQL 均支持)
+    """
+    interactions = [i for i in interactions if i is not None]
+    conversation = interactions[0].conversation
+    with transaction.atomic():
+        recent = getattr(conversation, 'recent_ix', None)
+        if recent is not None:
+            list(Conversation.objects.select_for_update().filter(pk=conversation.pk).values_list('pk', flat=True))
+            last_seen_id = recent[0].id if recent else 0
+            if Interaction.objects.filter(conversation_id=conversation.pk, id__gt=last_seen_id).exists():
+                raise ConcurrentTurnError()
+        Interaction.objects.bulk_create(interactions)
+        if conversation_updates:
+            Conversation.objects.filter(pk=conversation.pk).update(updated_at=timezone.now(), **conversation_updates)
+            for field, value in conversation_updates.items():
+                # F() 表达式在数据库里计算，不回写到实例上
+                if not hasattr(value, 'resolve_expression'):
+                    setattr(conversation, field, value)
+
+# probe_deeper 缺少引导问题时，让模型补一个问题用的 Prompt（模板固定，只填入用户输入和话题）
+_PROBE_QUESTION_PROMPT = """
+Context: User says "{user_input}" (indicating they don't know).
+Current Topic: {topic}
+Task: Ask a simple, intuitive question to help them guess.
+Do NOT say "Never mind" or "Let's imagine". Just ask the question directly.
+Example: "What do you think happens if...?"
+Language: Chinese.
+"""
+
+# 相对论演示的触发词；判断显式触发前先去掉中英文问号
+_DEMO_KEYWORDS_RE = re.compile(r'引力|相对论')
+_QUESTION_MARKS = str.maketrans('', '', '？?')
+
+def _sse_event(data):
+    return b"data: " + orjson.dumps(data) + b"\n\n"
+
+def _text_reply(conversation, user_interaction, text, challenge=None, final_review=None, **conversation_updates):
+    """
+    文字回复和本轮用户消息一起写库，回复 {'answer'}
+    challenge 存进 AI 回复的 metadata 并一起返回；final_review 只返回给前端
+    """
+    _save_turn(user_interaction, Interaction(
+        conversation=conversation, type='ai_feedback', text_content=text,
+        metadata={'challenge': challenge} if challenge else None
+    ), **conversation_updates)
+    payload = {'status': 'success', 'answer': text}
+    if challenge:
+        payload['challenge'] = challenge
+    if final_review:
+        payload['final_review'] = final_review
+    return json_response(payload)
+
+def _image_reply(conversation, user_interaction, text, prompt, generate_image, stream=False, **conversation_updates):
+    """
+    生成图片并和本轮用户消息一起写库，回复 {'answer', 'image_url'}
+    stream=True 时返回 SSE：先推送文字，图片在后台线程生成、写库后再推送 image_url
+    prompt 也可以是无参函数（需要先让模型写 prompt 时），在后台线程里和生图连着执行，不挡住文字推送
+    """
+    def produce():
+        image_prompt = prompt() if callable(prompt) else prompt
+        image_url = generate_image(image_prompt)
+        image_interaction = Interaction(
+            conversation=conversation, type='ai_image',
+            image_url=image_url, image_prompt=image_prompt, text_content=text
+        )
+        _save_turn(user_interaction, image_interaction, **conversation_updates)
+        enqueue_image_persist(image_interaction.id, image_url, image_prompt)
+        return image_url
+
+    if not stream:
+        return json_response({'status': 'success', 'answer': text, 'image_url': produce()})
+
+    # 先开始生图，再推送文字；客户端断开也不影响本轮写库
+    future = run_image_task(produce)
+
+    def events():
+        yield _sse_event({'status': 'success', 'answer': text})
+        try:
+            image_url = future.result()
+        except ConcurrentTurnError:
+            logger.info("Discarded stale turn for conversation %s", conversation.pk)
+            yield _sse_event({'status': 'error', 'message': _DISCARDED_MESSAGE})
+            return
+        except Exception as e:
+            logger.exception("Image generation failed for reply: %s", text)
+            yield _sse_event({'status': 'error', 'message': str(e)})
+            return
+        yield _sse_event({'image_url': image_url})
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+def get_deepseek_service():
+    # 导入 deepseek_service 会连带导入 openai / httpx（约 0.4 秒），推迟到第一次处理消息时
+    from .services.deepseek_service import get_service
+    return get_service()
+
+# 对话标题取用户第一个问题的前 30 个字符（侧边栏展示用）
+TOPIC_LENGTH = 30
+
+def _topic_from(user_input):
+    # 先做 NFC 规范化再截断：组合字符（如 e + ́）合成一个字符，截断时不会只留下一半
+    return unicodedata.normalize('NFC', user_input or '').strip()[:TOPIC_LENGTH]
+
+def _saved_image_url(save_future):
+    """
+    等后台写盘完成，返回上传图片的本地地址（没有上传或保存失败时为 None）
+    """
+    if save_future is None:
+        return None
+    return save_future.result()[0]
+
+def _handle_chat_response(conversation, user_input, image_file=None, stream=False):
     # Fallback text if only image provided
-    if not user_input and uploaded_image_url:
+    if not user_input and image_file:
         user_input = "[用户上传了一张图片]"
     
     # --- DEMO MODE CHECK ---
     # Check for "Relativity Demo" trigger
     # Trigger 1: Explicit command "广义相对论是什么？"
     # Trigger 2: User asks specifically about "引力" or "相对论" as the FIRST question
+    # 两种触发都要求出现“引力”或“相对论”：先用一次正则扫描筛掉绝大多数消息
     is_demo_trigger = False
-    if "广义相对论是什么" in user_input.replace("？", "").replace("?", ""):
-        is_demo_trigger = True
-        user_input = "为什么会有引力？" # Normalize input for demo start
-    elif conversation.interactions.count() <= 1 and ("引力" in user_input or "相对论" in user_input):
-        # Only auto-trigger on first interaction
-        is_demo_trigger = True
+    if _DEMO_KEYWORDS_RE.search(user_input):
+        if "广义相对论是什么" in user_input.translate(_QUESTION_MARKS):
+            is_demo_trigger = True
+            user_input = "为什么会有引力？" # Normalize input for demo start
+        elif len(_recent_interactions(conversation)) <= 1:
+            # Only auto-trigger on first interaction
+            is_demo_trigger = True
     
     # If we are already IN a demo sequence (conversation marked as demo), continue the script
     # We can use a special topic prefix like "[DEMO] Relativity" to track state
-    if is_demo_trigger or conversation.topic.startswith("[DEMO]"):
-        return _handle_relativity_demo(conversation, user_input, is_demo_trigger, uploaded_image_url)
+    is_demo = is_demo_trigger or conversation.topic.startswith("[DEMO]")
     # -----------------------
 
-    # 1. Review 状态
-    if conversation.status == 'review':
-        return JsonResponse({'status': 'success', 'answer': '思考已完成。'})
+    # 1. Review 状态：固定回复，在取模型服务、读取和保存上传图片之前直接返回
+    if not is_demo and conversation.status == 'review':
+        return json_response({'status': 'success', 'answer': '思考已完成。'})
+
+    ai_service = get_deepseek_service()
+    
+    # Check if image uploaded
+    # 上传的图片只读一次：后台线程写盘，本线程把同一份 bytes 交给视觉模型，两者同时进行
+    uploaded_image_bytes = None
+    save_future = None
+    
+    if image_file:
+        uploaded_image_bytes = image_file.read()
+        save_future = run_image_task(save_uploaded_bytes, uploaded_image_bytes, image_file.name)
+
+    if is_demo:
+        return _handle_relativity_demo(conversation, user_input, is_demo_trigger, _saved_image_url(save_future), stream)
+
+    # 分析图片的同时图片在后台写盘，分析完再取保存后的地址
+    image_analysis = None
+    if uploaded_image_bytes is not None:
+        image_analysis = ai_service.analyze_image_bytes(uploaded_image_bytes, user_input)
+    uploaded_image_url = _saved_image_url(save_future)
 
     # 2. Initial Probe 状态
     if conversation.status == 'initial_probe':
-        # 记录用户回答（问题）
-        Interaction.objects.create(
+        # 记录用户回答（问题），和 AI 回复一起写入
+        question_interaction = Interaction(
             conversation=conversation, 
             type='question', 
             text_content=user_input,
@@ -97,26 +332,21 @@ def _handle_chat_response(conversation, user_input, image_file=None):
         # But for now, let's keep it simple: just save it and proceed with standard flow.
         # Unless we want to use vision analysis to set the topic?
         
-        if uploaded_image_path:
+        if image_analysis is not None:
              # Analyze image to understand user intent/topic
-             analysis = ai_service.analyze_image_content(uploaded_image_path, user_input)
+             analysis = image_analysis
              answer = f"我看到了你上传的图片。AI分析结果：{analysis}\n\n基于此，你有什么想进一步探讨的问题吗？"
         else:
             answer = ai_service.generate_initial_probe(user_input)
             if not answer:
                 answer = "收到。关于这个问题，你现在有什么初步的想法或直觉吗？"
         
-        Interaction.objects.create(conversation=conversation, type='ai_feedback', text_content=answer)
-        
-        conversation.status = 'visual_loop' 
-        conversation.topic = user_input[:30]
-        conversation.save()
-        
-        return JsonResponse({'status': 'success', 'answer': answer})
+        return _text_reply(conversation, question_interaction, answer, status='visual_loop', topic=_topic_from(user_input))
         
     # 3. Visual Loop 状态
     elif conversation.status == 'visual_loop':
-        last_interaction = conversation.interactions.last()
+        recent = _recent_interactions(conversation)
+        last_interaction = recent[0] if recent else None
         
         # 记录用户输入 (Unified here, removed duplicate creates below)
         user_interaction_type = 'probe_answer' if last_interaction and last_interaction.type == 'ai_feedback' else 'user_interpretation'
@@ -127,17 +357,19 @@ def _handle_chat_response(conversation, user_input, image_file=None):
         # Create interaction ONLY if user_input is not empty (or image uploaded)
         # Check if we just created one? No, this is the main entry point for visual_loop.
         
+        # 先不写库，和本轮 AI 回复一起由 _save_turn 写入
+        user_interaction = None
         if user_input or uploaded_image_url:
-            Interaction.objects.create(
+            user_interaction = Interaction(
                 conversation=conversation, 
                 type=user_interaction_type, 
                 text_content=user_input,
                 image_url=uploaded_image_url
             )
 
-        if uploaded_image_path:
+        if image_analysis is not None:
              # Analyze image
-             analysis = ai_service.analyze_image_content(uploaded_image_path, user_input)
+             analysis = image_analysis
              
              # 判断用户意图：如果是上传题目求助，不要直接返回分析结果，而是进入引导模式
              # 这里我们把图片分析结果作为 Context 喂给 analyze_user_input
@@ -152,13 +384,16 @@ def _handle_chat_response(conversation, user_input, image_file=None):
              # 那么直接返回 analysis 即可。
              # 现在的 analyze_image_content 已经配置为苏格拉底式引导。
              
-             Interaction.objects.create(conversation=conversation, type='ai_feedback', text_content=analysis)
-             return JsonResponse({'status': 'success', 'answer': analysis})
+             return _text_reply(conversation, user_interaction, analysis)
 
-        recent_interactions = conversation.interactions.all().order_by('-created_at')[:5]
-        recent_interactions = reversed(recent_interactions)
-        
-        context = "\n".join([f"{i.type}: {i.text_content or i.image_prompt}" for i in recent_interactions])
+        # 最近 5 条上下文：本轮用户消息还没写库，从已取回的最近记录里少用一条再补上
+        history_size = 4 if user_interaction else 5
+        # recent 按 id 倒序，切片反转成时间正序（内存里 5 条以内，不再查库）
+        recent_interactions = recent[:history_size][::-1]
+        if user_interaction:
+            recent_interactions.append(user_interaction)
+        
+        context = "\n".join(f"{i.type}: {i.text_content or i.image_prompt}" for i in recent_interactions)
         analysis = ai_service.analyze_user_input(conversation.topic, user_input, context)
         
         intent = analysis.get('intent')
@@ -195,19 +430,11 @@ def _handle_chat_response(conversation, user_input, image_file=None):
              if not guide_text or guide_text == "没关系。试着想象一下，如果我们改变一个条件...":
                  # 强制让 DeepSeek 生成一个具体的、针对上下文的引导问题
                  # 这里我们再次调用 DeepSeek 生成一个简单的文本引导
-                 prompt = f"""
-                 Context: User says "{user_input}" (indicating they don't know).
-                 Current Topic: {conversation.topic}
-                 Task: Ask a simple, intuitive question to help them guess. 
-                 Do NOT say "Never mind" or "Let's imagine". Just ask the question directly.
-                 Example: "What do you think happens if...?"
-                 Language: Chinese.
-                 """
+                 prompt = _PROBE_QUESTION_PROMPT.format(user_input=user_input, topic=conversation.topic)
                  messages = [{"role": "user", "content": prompt}]
                  guide_text = ai_service.chat_completion(messages)
 
-             Interaction.objects.create(conversation=conversation, type='ai_feedback', text_content=guide_text)
-             return JsonResponse({'status': 'success', 'answer': guide_text})
+             return _text_reply(conversation, user_interaction, guide_text)
              
         elif intent == 'no_idea' or intent == 'has_idea':
             # 只有 has_idea (或者 no_idea 的特殊情况) 才生图
@@ -218,255 +445,184 @@ def _handle_chat_response(conversation, user_input, image_file=None):
                 latex = analysis.get('desmos_latex', '')
                 guide_text = visual_guide_text if visual_guide_text else "这是一个数学函数图像，试着调整参数看看会发生什么？"
                 
-                Interaction.objects.create(
+                _save_turn(user_interaction, Interaction(
                     conversation=conversation,
                     type='ai_image',
                     text_content=guide_text,
                     image_prompt=f"DESMOS: {latex}"
-                )
-                return JsonResponse({
+                ))
+                return json_response({
                     'status': 'success', 
                     'answer': guide_text, 
                     'desmos_latex': latex
                 })
             else:
-                prompt = visual_prompt if visual_prompt else ai_service.generate_visual_prompt(conversation.topic, user_input if intent == 'has_idea' else "Concept of " + conversation.topic)
-                image_url = ai_service.generate_image(prompt)
-                guide_text = visual_guide_text if visual_guide_text else "这是一张为你生成的视觉线索图。请仔细观察它，你看到了什么？这与你的问题有什么联系？"
-
-                Interaction.objects.create(
-                    conversation=conversation,
-                    type='ai_image',
-                    image_url=image_url,
-                    image_prompt=prompt,
-                    text_content=guide_text
+                # analysis 没给出 prompt 时由模型补写，放进生图的后台任务里，流式时文字先推送
+                prompt = visual_prompt or functools.partial(
+                    ai_service.generate_visual_prompt, conversation.topic,
+                    user_input if intent == 'has_idea' else "Concept of " + conversation.topic
                 )
-                return JsonResponse({'status': 'success', 'answer': guide_text, 'image_url': image_url})
+                guide_text = visual_guide_text if visual_guide_text else "这是一张为你生成的视觉线索图。请仔细观察它，你看到了什么？这与你的问题有什么联系？"
+                return _image_reply(conversation, user_interaction, guide_text, prompt, ai_service.generate_image, stream)
 
         elif intent == 'verify_understanding':
             # AI wants to verify understanding with a Fill-in-the-Blank challenge
             fill_data = analysis.get('fill_in_the_blank', {})
             guide_text = visual_guide_text if visual_guide_text else "看来你已经抓住关键了。来做一个小测试验证一下你的理解。"
             
-            # Save fill-in-the-blank data into interaction metadata (text_content will store JSON string or we add a field)
-            # For simplicity, we embed it in text_content with a special marker or just return it in JSON response
-            # But we need to save it to history.
-            # Let's use a special prefix or just save the guide text, and frontend handles the interactive part if it's live.
-            # But if we reload page, we need the data.
-            # So, we should store it. Let's assume Interaction has a flexible field or we append to text.
-            
-            # Pack data into a structured format for frontend
+            # 挑战题数据存进 Interaction.metadata，刷新页面后前端直接读取，不再拼进 text_content
             challenge_payload = {
                 "type": "fill_in_the_blank",
                 "data": fill_data
             }
-            
-            Interaction.objects.create(
-                conversation=conversation,
-                type='ai_feedback',
-                text_content=guide_text,
-                # We might need a 'metadata' field in Interaction model for clean architecture, 
-                # but for now let's append a hidden JSON block
-                # Or relying on the fact that for current session, we return it in API response.
-                # For history persistence, we might lose the interactive widget if we don't save it.
-                # Hack: Append <CHALLENGE>JSON</CHALLENGE> to text_content
-            )
-            
-            # Update the text content with hidden data
-            full_content = guide_text + f"\n<CHALLENGE>{json.dumps(challenge_payload)}</CHALLENGE>"
-            conversation.interactions.last().text_content = full_content
-            conversation.interactions.last().save()
-
-            return JsonResponse({
-                'status': 'success', 
-                'answer': guide_text,
-                'challenge': challenge_payload
-            })
+            return _text_reply(conversation, user_interaction, guide_text, challenge=challenge_payload)
 
         elif intent == 'finish':
             # AI determined that the logical chain is complete
-            conversation.status = 'review'
-            conversation.save()
-            
             guide_text = "你已经完成了整个视觉探索旅程。现在，请试着用一句话总结：为什么会有石油？（这是最后一步，请给出你的定义）"
             
-            Interaction.objects.create(
-                conversation=conversation,
-                type='ai_feedback',
-                text_content=guide_text
-            )
-            return JsonResponse({'status': 'success', 'answer': guide_text})
+            return _text_reply(conversation, user_interaction, guide_text, status='review')
 
         elif intent == 'explaining_image':
             is_pass = analysis.get('evaluation') == 'pass'
             
             if is_pass:
-                # Mark the current user interaction as passed
-                current_user_interaction = conversation.interactions.last()
-                if current_user_interaction:
-                    current_user_interaction.is_passed = True
-                    current_user_interaction.save()
+                # Mark the current user interaction as passed（还没写库，直接随本轮一起 INSERT）
+                if user_interaction:
+                    user_interaction.is_passed = True
 
                 # Generate next step image
-                prompt = visual_prompt if visual_prompt else ai_service.generate_visual_prompt(conversation.topic, "Next step after: " + user_input)
-                image_url = ai_service.generate_image(prompt)
+                prompt = visual_prompt or functools.partial(ai_service.generate_visual_prompt, conversation.topic, "Next step after: " + user_input)
                 guide_text = visual_guide_text if visual_guide_text else "很有趣的解读。现在，让我们看看下一张图，它揭示了更深的一层含义..."
-
-                Interaction.objects.create(
-                    conversation=conversation,
-                    type='ai_image',
-                    image_url=image_url,
-                    image_prompt=prompt,
-                    text_content=guide_text
-                )
-                return JsonResponse({'status': 'success', 'answer': guide_text, 'image_url': image_url})
+                return _image_reply(conversation, user_interaction, guide_text, prompt, ai_service.generate_image, stream)
             else:
                 hint = analysis.get('next_step_hint', '请再仔细看看。')
-                Interaction.objects.create(conversation=conversation, type='ai_feedback', text_content=hint)
-                return JsonResponse({'status': 'success', 'answer': hint})
+                return _text_reply(conversation, user_interaction, hint)
 
     # 4. Review 状态 (Final Synthesis)
     elif conversation.status == 'review':
          # User just submitted their synthesis
          # AI needs to evaluate it and give final closure
          
-         # Save user's synthesis
-         Interaction.objects.create(
-            conversation=conversation, 
-            type='user_synthesis', 
-            text_content=user_input
-         )
-         
          final_review = {
             "summary": "你通过观察与推理，最终得出了结论。",
             "thinking_path": [{"stage": "Done", "description": "User synthesized the answer."}],
             "advice": f"你的总结：'{user_input}' 抓住了核心。保持这种观察力。"
          }
          
-         conversation.is_completed = True
-         conversation.save()
-         
-         ThinkingReview.objects.create(
-            conversation=conversation,
-            summary_text=final_review['summary'],
-            thinking_path_json=final_review['thinking_path'],
-            advice_text=final_review['advice']
-         )
+         # 用户的总结、对话完成标记和复盘记录一起提交
+         with transaction.atomic():
+             _save_turn(
+                Interaction(conversation=conversation, type='user_synthesis', text_content=user_input),
+                is_completed=True
+             )
+             ThinkingReview.objects.create(
+                conversation=conversation,
+                summary_text=final_review['summary'],
+                thinking_path_json=final_review['thinking_path'],
+                advice_text=final_review['advice']
+             )
          
-         return JsonResponse({'status': 'success', 'answer': f"<FINAL_REVIEW>{json.dumps(final_review)}</FINAL_REVIEW>"})
+         return json_response({'status': 'success', 'answer': '', 'final_review': final_review})
          
     else:
-        Interaction.objects.create(conversation=conversation, type='ai_feedback', text_content="我不太理解。请试着描述图片与问题的关系。")
-        return JsonResponse({'status': 'success', 'answer': "我不太理解..."})
+        _save_turn(Interaction(conversation=conversation, type='ai_feedback', text_content="我不太理解。请试着描述图片与问题的关系。"))
+        return json_response({'status': 'success', 'answer': "我不太理解..."})
+
+# 演示脚本每一步的图片 prompt 是固定的：图片转存到本地后，地址在进程内记住，之后连缓存都不用查
+# 只记本地地址：生图服务返回的原始链接会过期；失败时的占位图不会被转存，所以也不会被记住，下次重新生成
+_demo_image_urls = {}
+
+def _cached_image(ai_service, prompt):
+    image_url = _demo_image_urls.get(prompt)
+    if image_url is None:
+        image_url = ai_service.generate_image(prompt)
+        if image_url and image_url.startswith(settings.MEDIA_URL):
+            _demo_image_urls[prompt] = image_url
+    return image_url
+
+# 相对论演示脚本：第 1-3 步各是一张固定的图 + 一段引导，第 4 步是填空挑战，之后结束
+RELATIVITY_SCRIPT = [
+    {
+        # Step 1: The Void (Inertia)
+        'prompt': "Minimalist abstract art. An infinite, perfectly flat white grid lines on light gray background. 2D plane. Nothing else. Clean, scientific style.",
+        'text': "第一步：这是宇宙的初始状态，一片绝对平坦、空无一物的空间。\n\n**提问**：如果在这个绝对平坦的表面上，你向前方滚出一颗弹珠，它会怎么运动？会停下来，还是永远走直线？",
+    },
+    {
+        # Step 2: The Mass (Curvature)
+        'prompt': "Minimalist 3D render. A heavy, dark matte sphere sitting in the center of a white grid. The grid lines bend and sink deeply underneath the sphere's weight, creating a funnel shape or gravity well. High contrast.",
+        'text': "现在，我们在中心放入一个极重的星球（比如太阳）。\n\n**观察**：请仔细看它周围的网格。发生了什么变化？那个原本平坦的舞台现在变得怎么样了？",
+    },
+    {
+        # Step 3: The Interaction (Gravity as Geometry)
+        'prompt': "Minimalist physics diagram. Top-down view. A large central mass distorting the grid. A small marble is rolling past it. The path of the marble curves towards the center, following the bent grid lines. Dashed line showing the path.",
+        'text': "关键时刻来了。现在有一颗小行星飞过。它本想继续走直线，但地面已经塌陷了。\n\n**思考**：它的路径看起来会是怎样的？看起来像是被太阳‘吸’过去了吗？还是它只是在顺着弯路走？",
+    },
+]
 
-def _handle_relativity_demo(conversation, user_input, is_start, uploaded_image_url):
+RELATIVITY_CHALLENGE = {
+    "type": "fill_in_the_blank",
+    "data": {
+        "question": "引力的本质不是力，而是 ___ 的弯曲。",
+        "correct_answer": "时空",
+        "hint": "时间和空间..."
+    }
+}
+
+RELATIVITY_FINAL_REVIEW = {
+    "summary": "通过构建空间模型，你领悟了引力即几何。",
+    "thinking_path": [{"stage": "Done", "description": "Relativity Demo Completed"}],
+    "advice": "下次看到苹果落地，试着想象一下空间本身的滑梯。"
+}
+
+def _handle_relativity_demo(conversation, user_input, is_start, uploaded_image_url, stream=False):
     """
     Hardcoded script for "General Relativity for Babies" style demo.
     Refined for maximum "Anti-AI Addiction" philosophy: Socratic, Visual, Insight-driven.
     """
     
-    step = conversation.interactions.filter(type__in=['ai_feedback', 'ai_image']).count()
-    ai_service = DeepSeekService()
+    # 每一步恰好写入一条 AI 回复，demo_step 随之 +1，等同于统计 ai_feedback / ai_image 的条数
+    step = conversation.demo_step
+    ai_service = get_deepseek_service()
     
     # Initialize Demo
     if is_start:
-        conversation.topic = "[DEMO] Relativity"
-        conversation.status = 'visual_loop' 
-        conversation.save()
-        
-        # Save user question
-        Interaction.objects.create(conversation=conversation, type='question', text_content=user_input)
-        
         # Step 0: The Hook
         answer = "我们忘掉那些复杂的公式。想象我们要从零开始构建一个宇宙。准备好了吗？"
-        Interaction.objects.create(conversation=conversation, type='ai_feedback', text_content=answer)
-        return JsonResponse({'status': 'success', 'answer': answer})
-
-    # Save user input for current step
-    Interaction.objects.create(conversation=conversation, type='user_interpretation', text_content=user_input, image_url=uploaded_image_url)
-
-    # Script Steps
-    
-    if step == 1: 
-        # Step 1: The Void (Inertia)
-        prompt = "Minimalist abstract art. An infinite, perfectly flat white grid lines on light gray background. 2D plane. Nothing else. Clean, scientific style."
-        text = "第一步：这是宇宙的初始状态，一片绝对平坦、空无一物的空间。\n\n**提问**：如果在这个绝对平坦的表面上，你向前方滚出一颗弹珠，它会怎么运动？会停下来，还是永远走直线？"
-        
-        image_url = ai_service.generate_image(prompt)
-        
-        Interaction.objects.create(
-            conversation=conversation, type='ai_image', 
-            image_url=image_url, image_prompt=prompt, text_content=text
+        return _text_reply(
+            conversation, Interaction(conversation=conversation, type='question', text_content=user_input), answer,
+            topic="[DEMO] Relativity",
+            status='visual_loop',
+            # 只在开始时统计一次已有的 AI 回复（含开场白和刚写入的这条），之后逐步递增
+            demo_step=demo_step_count()
         )
-        return JsonResponse({'status': 'success', 'answer': text, 'image_url': image_url})
 
-    elif step == 2: 
-        # Step 2: The Mass (Curvature)
-        prompt = "Minimalist 3D render. A heavy, dark matte sphere sitting in the center of a white grid. The grid lines bend and sink deeply underneath the sphere's weight, creating a funnel shape or gravity well. High contrast."
-        text = "现在，我们在中心放入一个极重的星球（比如太阳）。\n\n**观察**：请仔细看它周围的网格。发生了什么变化？那个原本平坦的舞台现在变得怎么样了？"
-        
-        image_url = ai_service.generate_image(prompt)
-        
-        Interaction.objects.create(
-            conversation=conversation, type='ai_image', 
-            image_url=image_url, image_prompt=prompt, text_content=text
-        )
-        return JsonResponse({'status': 'success', 'answer': text, 'image_url': image_url})
+    # User input for current step, saved together with the step's reply
+    user_interaction = Interaction(conversation=conversation, type='user_interpretation', text_content=user_input, image_url=uploaded_image_url)
 
-    elif step == 3: 
-        # Step 3: The Interaction (Gravity as Geometry)
-        prompt = "Minimalist physics diagram. Top-down view. A large central mass distorting the grid. A small marble is rolling past it. The path of the marble curves towards the center, following the bent grid lines. Dashed line showing the path."
-        text = "关键时刻来了。现在有一颗小行星飞过。它本想继续走直线，但地面已经塌陷了。\n\n**思考**：它的路径看起来会是怎样的？看起来像是被太阳‘吸’过去了吗？还是它只是在顺着弯路走？"
-        
-        image_url = ai_service.generate_image(prompt)
-        
-        Interaction.objects.create(
-            conversation=conversation, type='ai_image', 
-            image_url=image_url, image_prompt=prompt, text_content=text
+    # Script Steps 1-3：查表得到固定的 prompt 和文字
+    if 1 <= step <= len(RELATIVITY_SCRIPT):
+        entry = RELATIVITY_SCRIPT[step - 1]
+        return _image_reply(
+            conversation, user_interaction, entry['text'], entry['prompt'],
+            functools.partial(_cached_image, ai_service), stream,
+            demo_step=F('demo_step') + 1
         )
-        return JsonResponse({'status': 'success', 'answer': text, 'image_url': image_url})
 
-    elif step == 4: 
+    elif step == len(RELATIVITY_SCRIPT) + 1:
         # Step 4: The Epiphany (Conclusion Challenge)
         guide_text = "没错。这就是爱因斯坦的洞见：根本没有看不见的‘拉力’。小行星只是在弯曲的空间里试图走直线而已。"
-        
-        challenge_payload = {
-            "type": "fill_in_the_blank",
-            "data": {
-                "question": "引力的本质不是力，而是 ___ 的弯曲。",
-                "correct_answer": "时空",
-                "hint": "时间和空间..."
-            }
-        }
-        
-        # Save challenge
-        full_content = guide_text + f"\n<CHALLENGE>{json.dumps(challenge_payload)}</CHALLENGE>"
-        
-        Interaction.objects.create(
-            conversation=conversation, type='ai_feedback', text_content=full_content
+        return _text_reply(
+            conversation, user_interaction, guide_text,
+            challenge=RELATIVITY_CHALLENGE, demo_step=F('demo_step') + 1
         )
         
-        return JsonResponse({
-            'status': 'success', 
-            'answer': guide_text,
-            'challenge': challenge_payload
-        })
-        
     else:
         # Finish
         guide_text = "你已经掌握了广义相对论的核心：**物质告诉时空如何弯曲，时空告诉物质如何运动**。\n\n这就是为什么我们不再需要‘引力’这个概念，我们只需要几何学。"
         
         # Mark completed
-        final_review = {
-            "summary": "通过构建空间模型，你领悟了引力即几何。",
-            "thinking_path": [{"stage": "Done", "description": "Relativity Demo Completed"}],
-            "advice": "下次看到苹果落地，试着想象一下空间本身的滑梯。"
-        }
-        conversation.is_completed = True
-        conversation.save()
-        
-        Interaction.objects.create(
-            conversation=conversation, type='ai_feedback', text_content=guide_text
-        )
-        
-        return JsonResponse({'status': 'success', 'answer': f"{guide_text}<FINAL_REVIEW>{json.dumps(final_review)}</FINAL_REVIEW>"})
\ No newline at end of file
+        return _text_reply(
+            conversation, user_interaction, guide_text,
+            final_review=RELATIVITY_FINAL_REVIEW, is_completed=True, demo_step=F('demo_step') + 1
+        )
\ No newline at end of file
@@ -93,6 +93,32 @@ DATABASES = {
 }
 
 
+# Cache
+# 设置 REDIS_URL 时使用 Redis（多进程共享 LLM 缓存），否则使用进程内缓存
+REDIS_URL = os.getenv('REDIS_URL')
+
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# 聊天消息走后台任务 + 轮询（Prefer: respond-async）：任务状态存在缓存里，轮询可能落到别的 worker，
+# 所以只有配置了共享缓存 (Redis) 时才开启，否则前端直接读 SSE 流
+CHAT_ASYNC_JOBS = bool(REDIS_URL)
+
+
+# 从 session 恢复用户时一并加载 profile
+AUTHENTICATION_BACKENDS = ['core.backends.ProfileModelBackend']
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -143,6 +169,13 @@ DEEPSEEK_API_KEY = os.getenv('DEEPSEEK_API_KEY')
 SILICONFLOW_API_KEY = os.getenv('SILICONFLOW_API_KEY')
 OPENROUTER_API_KEY = 'Please_Set_Your_OpenRouter_Key_Here' # Legacy
 
+# 初始引导语是否调用 LLM 生成（默认使用预置话术，省掉新对话的第一次模型调用）
+USE_LLM_PROBE = os.getenv('USE_LLM_PROBE', '').lower() in ('1', 'true', 'yes')
+
+# 进程启动时就创建模型服务（导入 openai、建连接池），第一个聊天请求不用再等；
+# 默认关闭，只处理普通页面的 worker 不加载 openai，启动更快、内存更少
+PRELOAD_AI_SERVICE = os.getenv('PRELOAD_AI_SERVICE', '').lower() in ('1', 'true', 'yes')
+
 # Desmos API Key (Default to demo key, but user should override in .env)
 DESMOS_API_KEY = os.getenv('DESMOS_API_KEY', 'dcb31709b452b1cf9dc26972add0fda6')
 
@@ -155,3 +188,29 @@ LOGIN_URL = '/accounts/login/'
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Logging
+# core 下的模块用 logging 输出；DEBUG 日志默认关闭，需要排查时设置 CORE_LOG_LEVEL=DEBUG
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'simple': {
+            'format': '{asctime} {levelname} {name}: {message}',
+            'style': '{',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'simple',
+        },
+    },
+    'loggers': {
+        'core': {
+            'handlers': ['console'],
+            'level': os.getenv('CORE_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}